@@ -0,0 +1,84 @@
+# Shared by run_experiments.py and plot-results.py, so the reason for a
+# result and the results store mean the same thing whichever wrote them.
+
+import functools
+import os
+import re
+
+# Named log signatures (regular expressions) in order of priority. The first
+# found is the reason, and they are compiled into one pattern for a single pass.
+signatures = [
+    ("success", r"Total wall time"),
+    ("missing gpu", r"libcuda\.so\.1: cannot open shared object file"),
+    ("mpi error", r"Other MPI error"),
+    # note this can be GLIBC or GLIBCXX
+    ("os abi issue", r"GLIBC\w*[^\n]*not found"),
+    ("pmi error", r"PMI\w*[^\n]*(?i:error|fail)"),
+    ("out of memory", r"OOMKilled|Out of memory|oom-kill|std::bad_alloc"),
+    ("image pull error", r"ErrImagePull|ImagePullBackOff|[Ff]ailed to pull image"),
+]
+
+# Columns of the results store (platform and experiment are partitions)
+store_schema = [
+    ("iter", "int64"),
+    ("size", "int64"),
+    ("gpu", "bool"),
+    ("success", "bool"),
+    ("reason", "string"),
+    ("wall_time", "double"),
+    ("total_wrapped_time", "double"),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def compile_signatures(rules):
+    """
+    Compile a tuple of (name, regex) rules into one pattern of named groups.
+    """
+    pattern = "|".join(f"(?P<rule{i}>{regex})" for i, (_, regex) in enumerate(rules))
+    return re.compile(pattern)
+
+
+def find_signatures(log, rules=None):
+    """
+    Get the names of the signatures found in a log (or line), in order of priority.
+    """
+    rules = tuple(rules or signatures)
+    found = {m.lastgroup for m in compile_signatures(rules).finditer(log)}
+    return [name for i, (name, _) in enumerate(rules) if f"rule{i}" in found]
+
+
+def get_reason_for_failure(log, rules=None):
+    """
+    Get reason for failure, or unknown if no signature matches.
+    """
+    found = find_signatures(log, rules)
+    return found[0] if found else "unknown"
+
+
+def get_store_name(iteration, size, gpu=False):
+    """
+    Get the name of a run in the store, the minicluster name (and if it used gpu).
+    """
+    name = f"lammps-{iteration}-size-{size}"
+    return f"{name}-gpu" if gpu else name
+
+
+def write_store(records, store, platform, experiment, name):
+    """
+    Write records for one run to the columnar (parquet) results store.
+
+    The store is partitioned by platform and experiment, with a file per
+    minicluster (see get_store_name), so writing the same run again replaces
+    it. The plotting scripts read it with only the columns they need.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([pa.field(name, kind) for name, kind in store_schema])
+    path = os.path.join(store, f"platform={platform}", f"experiment={experiment}")
+    os.makedirs(path, exist_ok=True)
+    filename = os.path.join(path, f"{name}.parquet")
+    table = pa.Table.from_pylist(records, schema=schema)
+    pq.write_table(table, f"{filename}.tmp")
+    os.replace(f"{filename}.tmp", filename)
@@ -2,17 +2,26 @@
 
 import argparse
 import collections
+import functools
+import hashlib
+import json
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 import metricsoperator.utils as utils
 import pandas
 import seaborn as sns
 
+import lammps_results
+
 plt.style.use("bmh")
 here = os.path.dirname(os.path.abspath(__file__))
 
+# The only columns we need to plot
+plot_columns = ["success", "reason", "experiment", "wall_time"]
+
 
 def get_parser():
     parser = argparse.ArgumentParser(
@@ -29,6 +38,32 @@ def get_parser():
         help="directory to save parsed results",
         default=os.path.join(here, "img"),
     )
+    parser.add_argument(
+        "--store",
+        help="columnar (parquet) results store to plot from, instead of parsing logs",
+    )
+    parser.add_argument(
+        "--update-store",
+        dest="update_store",
+        help="parse logs and add them to the store before plotting",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--signatures",
+        help="json file of extra log signatures (name to regular expression)",
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of processes to parse logs (defaults to cpu count)",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        help="parse all logs, ignoring the parse cache in the output directory",
+        action="store_true",
+    )
     return parser
 
 
@@ -74,6 +109,13 @@ def main():
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    # The results store already has parsed results, and we only read
+    # the columns we plot (for the platform of the results directory)
+    if args.store and not args.update_store:
+        df = read_store(args.store, os.path.basename(indir), plot_columns)
+        plot_results(df, outdir)
+        return
+
     # Find input files (skip anything with test)
     files = find_inputs(indir)
     # specs = find_specs(indir)
@@ -82,11 +124,51 @@ def main():
 
     # This does the actual parsing of data into a formatted variant
     # Has keys results, iters, and columns
-    df = parse_data(files)
+    cache_file = None
+    if not args.no_cache:
+        cache_file = os.path.join(outdir, "lammps-parse-cache.json")
+    rules = None
+    if args.signatures:
+        rules = load_signatures(args.signatures)
+    df = parse_data(files, workers=args.workers, cache_file=cache_file, rules=rules)
     df.to_csv(os.path.join(outdir, "lammps-times.csv"))
+    if args.store:
+        update_store(df, args.store)
     plot_results(df, outdir)
 
 
+def update_store(df, store):
+    """
+    Add parsed results to the store, one file per platform, experiment and minicluster.
+
+    The logs do not say if a run used gpu, so it is left empty.
+    """
+    columns = [name for name, _ in lammps_results.store_schema]
+    df = df[df.iter.notnull() & df["size"].notnull()]
+    for (platform, experiment, iteration, size), group in df.groupby(
+        ["platform", "experiment", "iter", "size"]
+    ):
+        records = group.assign(gpu=None).reindex(columns=columns).to_dict("records")
+        name = lammps_results.get_store_name(int(iteration), int(size))
+        lammps_results.write_store(records, store, platform, experiment, name)
+    print(f"Wrote {df.shape[0]} results to {store}")
+
+
+def read_store(store, platform, columns):
+    """
+    Read the columns we need for a platform from the results store.
+    """
+    df = pandas.read_parquet(
+        store, columns=columns, filters=[("platform", "==", platform)]
+    )
+    if df.empty:
+        raise ValueError(f"There are no {platform} results in {store}")
+
+    # Partitions are read as categories, and we rename experiments
+    df["experiment"] = df["experiment"].astype(str)
+    return df
+
+
 def plot_results(df, outdir):
     """
     Plot lammps results
@@ -200,73 +282,159 @@ def plot_results(df, outdir):
     )
 
 
-def get_reason_for_failure(log):
+def load_signatures(filename):
     """
-    Get reason for failure
+    Load signatures from json (name to regular expression) on top of the
+    defaults. A known name replaces the default, and new names are added last.
     """
-    if "Total wall time" in log:
-        return "success"
-    if "libcuda.so.1: cannot open shared object file" in log:
-        return "missing gpu"
-    if "Other MPI error" in log:
-        return "mpi error"
-    # note this can be GLIBC or GLIBCXX
-    if "GLIBC" in log and "not found" in log:
-        return "os abi issue"
-    else:
-        print("FOUND NEW ISSUE")
-        import IPython
+    with open(filename, "r") as fd:
+        custom = json.loads(fd.read())
+    signatures = lammps_results.signatures
+    updated = [(name, custom.pop(name, regex)) for name, regex in signatures]
+    return updated + list(custom.items())
 
-        IPython.embed()
 
+def get_excerpt(log, lines=10):
+    """
+    Get the end of a log (where failures usually are) to look at later.
+    """
+    return "\n".join([x for x in log.split("\n") if x.strip()][-lines:])
+
+
+def parse_log(filename, rules=None):
+    """
+    Parse one log file into a record for the data frame.
+    """
+    parsed = os.path.relpath(filename, here)
+    platform, experiment = parsed.split(os.sep)[1:3]
+    run = re.search("lammps-([0-9]+)-size-([0-9]+)", os.path.basename(filename))
+
+    # This can be split into pieces by ===
+    item = utils.read_file(filename)
+    reason = lammps_results.get_reason_for_failure(item, rules)
+
+    # Find the time if we were successful
+    wall_time = None
+    if reason == "success":
+        log = [x for x in item.split("\n") if "Total wall time" in x]
+
+        # This is the LAMMPS section with wall time
+        line = [x for x in log[0].split("\n") if "Total wall time" in x][0]
+        rawtime = line.split(":", 1)[-1].strip()
+        wall_time = utils.timestr2seconds(rawtime)
+
+    # Keep a bit of the log for anything we don't recognize
+    excerpt = None
+    if reason == "unknown":
+        excerpt = get_excerpt(item)
+        print(f"Unknown result for {filename}:\n{excerpt}")
+
+    # We just care about times for the data frame
+    return {
+        "success": reason == "success",
+        "reason": reason,
+        "experiment": experiment,
+        "wall_time": wall_time,
+        "excerpt": excerpt,
+        "platform": platform,
+        "iter": int(run.group(1)) if run else None,
+        "size": int(run.group(2)) if run else None,
+    }
+
+
+def get_rules_hash(rules=None):
+    """
+    Get a hash of the signature rules, which decide the reason of a record.
+
+    The store schema is included too, so records without new columns are parsed again.
+    """
+    rules = [list(x) for x in rules or lammps_results.signatures]
+    schema = [list(x) for x in lammps_results.store_schema]
+    content = json.dumps([rules, schema])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def read_cache(cache_file, rules_hash):
+    """
+    Read the parse cache, a lookup of filename to mtime and record.
 
-def parse_data(files):
+    Records parsed with different signature rules are stale, so the cache
+    is empty if the rules hash isn't the same.
+    """
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, "r") as fd:
+        cache = json.loads(fd.read())
+    if cache.get("rules") != rules_hash:
+        print("Signatures changed since the parse cache was written, ignoring it.")
+        return {}
+    return cache["logs"]
+
+
+def write_cache(cache, cache_file, rules_hash):
+    """
+    Write the parse cache, with the hash of the rules used.
+    """
+    with open(cache_file, "w") as fd:
+        fd.write(json.dumps({"rules": rules_hash, "logs": cache}))
+
+
+def parse_data(files, workers=None, cache_file=None, rules=None):
     """
     Given a listing of files, parse into results data frame
+
+    Logs are parsed across a process pool into records, and the data frame
+    is created once at the end. When a cache file is provided, logs with
+    the same path and mtime (and signature rules) as last time are not
+    parsed again.
     """
     # We used the same size / ranks for all of these
     # And it doesn't really matter
-    # Parse into data frame
-    df = pandas.DataFrame(
+    # Skip events files
+    files = [x for x in files if "topology" not in x]
+    rules_hash = get_rules_hash(rules)
+    cache = read_cache(cache_file, rules_hash)
+    records = {}
+    todo = []
+    for filename in files:
+        mtime = os.path.getmtime(filename)
+        cached = cache.get(filename)
+        if cached and cached["mtime"] == mtime:
+            records[filename] = cached["record"]
+        else:
+            todo.append(filename)
+    print(f"Parsing {len(todo)} logs, {len(records)} found in cache")
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for filename, record in zip(
+                todo,
+                executor.map(
+                    functools.partial(parse_log, rules=rules), todo, chunksize=16
+                ),
+            ):
+                records[filename] = record
+
+    if cache_file:
+        cache = {
+            filename: {"mtime": os.path.getmtime(filename), "record": record}
+            for filename, record in records.items()
+        }
+        write_cache(cache, cache_file, rules_hash)
+
+    # Parse into data frame, in the same order as the files
+    return pandas.DataFrame.from_records(
+        [records[filename] for filename in files],
         columns=[
             "success",
             "reason",  # reason for failure (or success)
             "experiment",
             "wall_time",
-        ]
+            "excerpt",  # end of the log when the reason is unknown
+            "platform",
+            "iter",
+        ],
     )
-    idx = 0
-
-    for filename in files:
-        # Skip events files
-        if "topology" in filename:
-            continue
-        parsed = os.path.relpath(filename, here)
-        experiment = parsed.split(os.sep)[2]
-
-        # This can be split into pieces by ===
-        item = utils.read_file(filename)
-        reason = get_reason_for_failure(item)
-
-        # Find the time if we were successful
-        wall_time = None
-        if reason == "success":
-            log = [x for x in item.split("\n") if "Total wall time" in x]
-
-            # This is the LAMMPS section with wall time
-            line = [x for x in log[0].split("\n") if "Total wall time" in x][0]
-            rawtime = line.split(":", 1)[-1].strip()
-            wall_time = utils.timestr2seconds(rawtime)
-
-        # We just care about times for the data frame
-        df.loc[idx, :] = [
-            reason == "success",
-            reason,
-            experiment,
-            wall_time,
-        ]
-        idx += 1
-    return df
 
 
 def make_plot(
@@ -2,23 +2,30 @@
 
 import argparse
 import copy
+import hashlib
 import json
 import os
 import subprocess
 import shutil
 import random
 import sys
-import tempfile
+import threading
+import time
 import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
+import lammps_results
 from jinja2 import Template
 from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 here = os.path.dirname(os.path.abspath(__file__))
 
 # Hard coded experiment templates
 lammps_template = os.path.join(here, "crd", "lammps.yaml")
+prepull_template = os.path.join(here, "crd", "prepull.yaml")
 
 six_config = [
     {"x": 2, "y": 2, "z": 2, "cpu_limit": 2, "tasks": 4, "size": 2},
@@ -104,17 +111,45 @@ req = {
 }
 
 
+# Lines in the log that mark when the broker and LAMMPS start and finish
+log_markers = {
+    "broker_quorum": "quorum->run",
+    "lammps_start": "LAMMPS (",
+    "lammps_end": "Total wall time",
+}
+
+# Buffer log writes instead of flushing each line
+log_buffer_size = 1024 * 1024
+
+# Modes that do not use compspec for image selection
+non_descriptive_modes = ["basic", "platform", "platform-version"]
+
+# Pod phases that mean the containers have started (or finished)
+started_phases = ["Running", "Succeeded", "Failed"]
+
 # Pair up configs and named templates
 configs = {
     "lammps-six": {"config": six_config, "template": lammps_template},
 }
 
+# MiniCluster custom resource
+minicluster_group = "flux-framework.org"
+minicluster_version = "v1alpha2"
+minicluster_plural = "miniclusters"
+
 # This must work to continue
 config.load_kube_config()
-kube_client = client.CoreV1Api()
 
-# Try using a global watcher
-watcher = watch.Watch()
+# All clients share one connection pool, large enough for concurrent runs
+kube_config = client.Configuration.get_default_copy()
+kube_config.connection_pool_maxsize = 32
+api_client = client.ApiClient(kube_config)
+kube_client = client.CoreV1Api(api_client)
+apps_client = client.AppsV1Api(api_client)
+custom_client = client.CustomObjectsApi(api_client)
+
+# Miniclusters can finish at the same time and write to the same journal
+journal_lock = threading.Lock()
 
 
 def write_json(content, filename):
@@ -142,6 +177,51 @@ def read_file(filename):
     return content
 
 
+def read_json(filename):
+    """
+    Read json from file
+    """
+    return json.loads(read_file(filename))
+
+
+def append_journal(record, filename):
+    """
+    Append one record to a JSON Lines journal, and sync it to disk.
+
+    If a previous run crashed mid-write, we start on a new line so the
+    partial record doesn't corrupt this one.
+    """
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    with journal_lock:
+        with open(filename, "ab+") as fd:
+            if fd.tell() > 0:
+                fd.seek(-1, os.SEEK_END)
+                if fd.read(1) != b"\n":
+                    line = b"\n" + line
+            fd.write(line)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+
+def read_journal(filename):
+    """
+    Read records from a JSON Lines journal, skipping partial lines.
+    """
+    records = []
+    if not os.path.exists(filename):
+        return records
+    with open(filename, "r") as fd:
+        for line in fd:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Skipping partial record in {filename}")
+    return records
+
+
 def load_yaml(filename):
     """
     Read yaml from file.
@@ -153,25 +233,70 @@ def load_yaml(filename):
 
 def save_nodes(logfile):
     """
-    Save node configuration.
+    Save node configuration, and return the nodes for capacity checks.
     """
     cluster_nodes = kube_client.list_node()
     nodes = cluster_nodes.to_str()
     write_file(nodes, logfile)
+    return cluster_nodes
+
+
+def parse_cpu(quantity):
+    """
+    Parse a Kubernetes cpu quantity (e.g., 8 or 7910m) into cores.
+    """
+    quantity = str(quantity)
+    if quantity.endswith("m"):
+        return int(quantity[:-1]) / 1000
+    return float(quantity)
+
+
+def get_capacity(cluster_nodes, cfgs):
+    """
+    Get the number of miniclusters the cluster can hold at once.
+
+    We count the pods (of the largest cpu limit) that fit on each schedulable
+    node, and then divide by the largest minicluster size. This is conservative,
+    but we don't want pods sitting in Pending and counting against the time.
+    """
+    cpu_limit = max(cfg["cpu_limit"] for cfg in cfgs)
+    size = max(cfg["size"] for cfg in cfgs)
+    slots = 0
+    for node in cluster_nodes.items:
+        if node.spec.unschedulable:
+            continue
+        slots += int(parse_cpu(node.status.allocatable["cpu"]) // cpu_limit)
+    return max(1, slots // size)
 
 
 def submit_job(minicluster_yaml):
     """
     Create the job in Kubernetes.
-    """
-    fd, filename = tempfile.mkstemp(suffix=".yaml", prefix="minicluster-")
-    os.remove(filename)
-    os.close(fd)
-    write_file(minicluster_yaml, filename)
 
-    # Create the minicluster
-    o, e = run_command(["kubectl", "apply", "-f", filename])
-    os.remove(filename)
+    If the minicluster exists (e.g., left from a run that crashed), it is
+    deleted and created again, so we don't watch (and time) its old pods.
+    Returns the time.monotonic() of the create that worked, to time from.
+    """
+    minicluster = yaml.safe_load(minicluster_yaml)
+    kwargs = {
+        "group": minicluster_group,
+        "version": minicluster_version,
+        "namespace": "default",
+        "plural": minicluster_plural,
+        "body": minicluster,
+    }
+    try:
+        start_time = time.monotonic()
+        custom_client.create_namespaced_custom_object(**kwargs)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        name = minicluster["metadata"]["name"]
+        print(f"Minicluster {name} already exists, deleting it first")
+        delete_minicluster(name)
+        start_time = time.monotonic()
+        custom_client.create_namespaced_custom_object(**kwargs)
+    return start_time
 
 
 def run_command(command, quiet=False):
@@ -193,15 +318,86 @@ def run_command(command, quiet=False):
     return o, e
 
 
+def timestr2seconds(timestr):
+    """
+    Convert a LAMMPS time string (e.g., 0:00:37) to seconds.
+    """
+    seconds = 0
+    for part in timestr.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def get_items(listing):
+    """
+    Get items and resourceVersion from a listing (custom objects are dicts).
+    """
+    if isinstance(listing, dict):
+        return listing["items"], listing["metadata"]["resourceVersion"]
+    return listing.items, listing.metadata.resource_version
+
+
+def wait_for_deletion(list_func, name, timeout=600, **kwargs):
+    """
+    Wait for a deleted object to be gone, using a watch on its name.
+
+    The watch is started again when it ends (or expires), until the object
+    is gone or we've waited timeout seconds in total (e.g., it is stuck on a
+    finalizer), and then we raise an error.
+    """
+    selector = f"metadata.name={name}"
+    deletion_watcher = watch.Watch()
+    deadline = time.monotonic() + timeout
+    while True:
+        items, resource_version = get_items(
+            list_func(field_selector=selector, **kwargs)
+        )
+        if not items:
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"{name} was not deleted in {timeout} seconds")
+        try:
+            for event in deletion_watcher.stream(
+                list_func,
+                field_selector=selector,
+                resource_version=resource_version,
+                timeout_seconds=max(1, int(remaining)),
+                **kwargs,
+            ):
+                if event["type"] == "DELETED":
+                    deletion_watcher.stop()
+                    return
+        except ApiException as e:
+            if e.status != 410:
+                raise
+
+
 def delete_minicluster(uid):
     """
     Delete the Minicluster, which includes an indexed job,
     config maps, and service.
+
+    Foreground deletion means the minicluster is only gone after the
+    pods are, which we confirm with a watch (like kubectl --wait=true).
     """
-    # --wait=true is default, but I want to be explicit
-    run_command(
-        ["kubectl", "delete", "miniclusters.flux-framework.org", uid, "--wait=true"]
-    )
+    kwargs = {
+        "group": minicluster_group,
+        "version": minicluster_version,
+        "namespace": "default",
+        "plural": minicluster_plural,
+    }
+    try:
+        custom_client.delete_namespaced_custom_object(
+            name=uid,
+            body=client.V1DeleteOptions(propagation_policy="Foreground"),
+            **kwargs,
+        )
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        return
+    wait_for_deletion(custom_client.list_namespaced_custom_object, uid, **kwargs)
 
 
 def record_line(filename, status, content):
@@ -212,63 +408,324 @@ def record_line(filename, status, content):
         f.write(f"\n===\n{status}: recorded-at: {datetime.utcnow()}\n{content}")
 
 
-def show_logs(name):
+def show_logs(name, log_file, timestamps=None, start=None, detect=False):
     """
-    Show lines from the log.
+    Stream lines from the log to a file, and return the number of lines
+    and the results (see lammps_results.signatures) detected, with the line
+    for each.
 
-    This will error when the pod isn't ready yet.
+    This will error when the pod isn't ready yet. The log is followed, so if
+    timestamps is provided we record when each log marker is first seen,
+    relative to start (a time.monotonic).
     """
-    lines = []
-    for line in watcher.stream(
-        kube_client.read_namespaced_pod_log,
-        name=name,
-        namespace="default",
-    ):
-        lines.append(line)
-    return "\n".join(lines)
+    count = 0
+    results = {}
+
+    # Each stream needs its own watcher, stopping one stops all its streams
+    log_watcher = watch.Watch()
+    with open(log_file, "w", buffering=log_buffer_size) as fd:
+        for line in log_watcher.stream(
+            kube_client.read_namespaced_pod_log,
+            name=name,
+            namespace="default",
+        ):
+            if timestamps is not None:
+                for key, marker in log_markers.items():
+                    if key not in timestamps and marker in line:
+                        timestamps[key] = time.monotonic() - start
+            if detect:
+                for result in lammps_results.find_signatures(line):
+                    if result not in results:
+                        print(f"Detected {result} in log for {name}")
+                        results[result] = line
+            fd.write(line + "\n")
+            count += 1
+    return count, results
+
+
+def is_scheduled(pod):
+    """
+    Determine if a pod has been assigned to a node.
+    """
+    conditions = pod.status.conditions or []
+    return any(c.type == "PodScheduled" and c.status == "True" for c in conditions)
 
 
-def get_logs(uid, meta, start_time, log_dir):
+def update_phases(pods, size, phases, elapsed):
+    """
+    Record when the pods leave pending and start running.
+
+    Pending is the time until all pods are scheduled, and image pull is the
+    time from there until all containers are started. Returns True when all
+    pods are running (or done).
+    """
+    if len(pods) != size:
+        return False
+    if "pending" not in phases and all(is_scheduled(p) for p in pods):
+        phases["pending"] = elapsed
+    if not all(p.status.phase in started_phases for p in pods):
+        return False
+    phases.setdefault("pending", elapsed)
+    phases["image_pull"] = elapsed - phases["pending"]
+    return True
+
+
+def check_timeout(label, start, timeout):
+    """
+    Raise an error if we've waited longer than the timeout, and return
+    the time remaining (or None if there is no timeout).
+    """
+    if not timeout:
+        return
+    remaining = timeout - (time.monotonic() - start)
+    if remaining <= 0:
+        raise TimeoutError(f"Minicluster {label} did not finish in {timeout} seconds")
+    return remaining
+
+
+def wait_for_pods(
+    label, size, phases, timeout=None, backoff=1, max_backoff=30, start=None
+):
+    """
+    Wait for the minicluster pods to be running, and return them.
+
+    We list once to get a resourceVersion, and then watch from it so we only
+    see the events that change. If the resourceVersion is too old (410) we list
+    again, and other API errors are retried with exponential backoff. Phase
+    times are relative to start (a time.monotonic), which defaults to now.
+    """
+    selector = f"app={label}"
+    start = start or time.monotonic()
+    pods = {}
+    resource_version = None
+    delay = backoff
+
+    # The watcher holds the resourceVersion, so we can't share one across threads
+    pod_watcher = watch.Watch()
+
+    while True:
+        remaining = check_timeout(label, start, timeout)
+        try:
+            # A new (or expired) watch needs a listing to know where to start
+            if resource_version is None:
+                listing = kube_client.list_namespaced_pod(
+                    label_selector=selector, namespace="default"
+                )
+                pods = {p.metadata.name: p for p in listing.items}
+                resource_version = listing.metadata.resource_version
+                elapsed = time.monotonic() - start
+                if update_phases(list(pods.values()), size, phases, elapsed):
+                    return list(pods.values())
+
+            # The server closes the watch at the timeout, and we reconnect
+            watch_timeout = 60 if remaining is None else max(1, min(60, remaining))
+            for event in pod_watcher.stream(
+                kube_client.list_namespaced_pod,
+                namespace="default",
+                label_selector=selector,
+                resource_version=resource_version,
+                timeout_seconds=int(watch_timeout),
+            ):
+                pod = event["object"]
+                resource_version = pod.metadata.resource_version
+                if event["type"] == "DELETED":
+                    pods.pop(pod.metadata.name, None)
+                else:
+                    pods[pod.metadata.name] = pod
+
+                elapsed = time.monotonic() - start
+                if update_phases(list(pods.values()), size, phases, elapsed):
+                    pod_watcher.stop()
+                    return list(pods.values())
+            delay = backoff
+
+        except ApiException as e:
+            if e.status == 410:
+                resource_version = None
+                continue
+            print(f"Error watching pods for {label}: {e.reason}, retry in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, max_backoff)
+
+
+def get_logs(
+    uid,
+    meta,
+    start_time,
+    log_dir,
+    timeout=None,
+    backoff=1,
+    max_backoff=30,
+    detect=False,
+):
     """
     Get the application mapping and performance logs
+
+    The start_time is the time.monotonic() when the minicluster was submitted.
+    The time (in seconds) for each phase (pending, image_pull, running)
+    is saved to the meta under phase_times, and the seconds since submit
+    for each event under timestamps. The log is streamed to {uid}.log, and
+    when detect is True the result (e.g., success) is saved under result.
     """
     log_file = os.path.join(log_dir, f"{uid}.log")
 
     # Find pods for minicluster
     label = meta["params"]["name"]
-
-    # Wait for pods
-    # Wait for the leader pod to be running before listing
-    while True:
-        pods = kube_client.list_namespaced_pod(
-            label_selector=f"app={label}", namespace="default"
-        )
-        # Phases here:
-        phases = [x.status.phase for x in pods.items]
-        is_running = all([p in ["Running", "Succeeded", "Failed"] for p in phases])
-        if len(pods.items) == meta["params"]["size"] and is_running:
-            break
+    timestamps = meta.setdefault("timestamps", {"submit": 0.0})
+
+    # Wait for the pods to be running before asking for logs
+    phases = {}
+    pods = wait_for_pods(
+        label,
+        meta["params"]["size"],
+        phases,
+        timeout=timeout,
+        backoff=backoff,
+        max_backoff=max_backoff,
+        start=start_time,
+    )
+    running_start = time.monotonic()
+    timestamps["pods_scheduled"] = phases["pending"]
+    timestamps["containers_started"] = running_start - start_time
 
     # And then the 0th index (leader) and the rest are workers (not used here)
     zero_index = f"{label}-0"
-    leader = [x for x in pods.items if x.metadata.name.startswith(zero_index)][0]
+    leader = [x for x in pods if x.metadata.name.startswith(zero_index)][0]
     print(f"Found minicluster leader pod {leader.metadata.name} to watch 👀️")
 
     # Stream log until it completes (and we will get events after)
     print(f"Waiting to get log for {uid} from pod {leader.metadata.name}")
+    delay = backoff
     while True:
         try:
-            log = show_logs(leader.metadata.name)
+            count, results = show_logs(
+                leader.metadata.name, log_file, timestamps, start_time, detect
+            )
 
             # If we hit the point where it's running but no logs...
-            if not log:
-                continue
-            break
-        except:
+            if count:
+                break
+        except ApiException as e:
+            print(f"Error getting log for {uid}: {e.reason}, retry in {delay}s")
+
+        # The stream can also break (or time out) part way through
+        except (ProtocolError, ReadTimeoutError) as e:
+            print(f"Log stream for {uid} was interrupted: {e}, retry in {delay}s")
+        check_timeout(label, start_time, timeout)
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff)
+
+    phases["running"] = time.monotonic() - running_start
+    timestamps["logs_complete"] = time.monotonic() - start_time
+    meta["phase_times"] = phases
+
+    # The result is known as soon as the log ends
+    if detect:
+        found = [r for r, _ in lammps_results.signatures if r in results]
+        found = found or ["unknown"]
+        meta["result"] = found[0]
+        print(f"Result for {uid} is {meta['result']}")
+        if meta["result"] == "success":
+            rawtime = results["success"].split(":", 1)[-1].strip()
+            meta["wall_time"] = timestr2seconds(rawtime)
+
+
+def get_pull_times(pod):
+    """
+    Get the seconds each image took to pull on a prepull pod.
+
+    Init containers run in order, so the time from when the previous one
+    finished (or the pod was scheduled) to when the next started is the pull.
+    """
+    scheduled = [c for c in pod.status.conditions or [] if c.type == "PodScheduled"]
+    last = scheduled[0].last_transition_time if scheduled else None
+    times = {}
+    for status in pod.status.init_container_statuses or []:
+        terminated = status.state.terminated
+        if not terminated:
             continue
+        if last is not None:
+            times[status.image] = (terminated.started_at - last).total_seconds()
+        last = terminated.finished_at
+    return times
 
-    # Save the log file
-    write_file(log, log_file)
+
+def delete_daemonset(name):
+    """
+    Delete a DaemonSet (if it exists), and wait for it to be gone.
+    """
+    try:
+        apps_client.delete_namespaced_daemon_set(
+            name=name,
+            namespace="default",
+            body=client.V1DeleteOptions(propagation_policy="Foreground"),
+        )
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        return
+    wait_for_deletion(apps_client.list_namespaced_daemon_set, name, namespace="default")
+
+
+def prepull_images(args, manifests, outdir):
+    """
+    Pull every image for the platform to every node before timed runs.
+
+    We deploy a DaemonSet with one init container per image (the LAMMPS
+    images and flux views), wait for all pods to be running, and save the
+    pull durations per node to prepull.json. The DaemonSet is then deleted
+    (even if we time out), and the images stay in each node's cache. One left
+    behind by a previous run is deleted and created again.
+    """
+    name = "lammps-prepull"
+    images = [x["name"] for x in manifests[args.platform]]
+    if args.platform == "amd64":
+        images += rocky_views + ubuntu_views
+    else:
+        images += rocky_arm_views + ubuntu_arm_views
+
+    template = Template(read_file(prepull_template))
+    daemonset_yaml = template.render({"name": name, "images": images})
+    write_file(daemonset_yaml, os.path.join(outdir, "prepull.yaml"))
+    print(f"Pulling {len(images)} images to all nodes 🚚️")
+    body = yaml.safe_load(daemonset_yaml)
+    try:
+        apps_client.create_namespaced_daemon_set(namespace="default", body=body)
+    except ApiException as e:
+        if e.status != 409:
+            raise
+        print(f"Deleting {name} left from a previous run")
+        delete_daemonset(name)
+        apps_client.create_namespaced_daemon_set(namespace="default", body=body)
+
+    try:
+        # Wait for the DaemonSet to know how many nodes it is on
+        desired = 0
+        while not desired:
+            daemonset = apps_client.read_namespaced_daemon_set_status(
+                name=name, namespace="default"
+            )
+            desired = daemonset.status.desired_number_scheduled
+            if not desired:
+                time.sleep(args.backoff)
+
+        phases = {}
+        pods = wait_for_pods(
+            name,
+            desired,
+            phases,
+            timeout=args.timeout,
+            backoff=args.backoff,
+            max_backoff=args.max_backoff,
+        )
+        pulls = {pod.spec.node_name: get_pull_times(pod) for pod in pods}
+        write_json(
+            {"images": images, "total_time": phases["image_pull"], "nodes": pulls},
+            os.path.join(outdir, "prepull.json"),
+        )
+        print(f"Images pulled to {desired} nodes in {phases['image_pull']:.2f} seconds")
+    finally:
+        delete_daemonset(name)
 
 
 def organize_manifests(manifests):
@@ -389,79 +846,367 @@ def generate_basic_base(args, manifests, cfg, name):
     return render
 
 
-def generate_descriptive_minicluster(args, manifest_file, cfg, name, mpi=False):
+def run_compspec_match(manifest_file, cache_path, matches):
     """
-    Generate a descriptive minicluster
+    Run compspec match to select a single (random) image.
+    """
+    # Generate metadata based on labels for compspec
+    cmd = ["compspec", "match", "-i", manifest_file, "--cache", cache_path]
+    for match in matches:
+        cmd += ["--match", match]
 
-    For the descriptive case, we are going to run compspec (with a cache)
-    to do image selection for us, accounting for a specific operating system,
-    version (for glibc) and gpu (or most likely not to start - can be exposed later).
-    When mpi is true, use the args.mode to further filter down to an mpi variant.
-    We know mpich is better on Google Cloud.
+    # We only want ONE match, and random selection
+    cmd += ["--single", "--randomize"]
+
+    # Run command to get matches
+    # Note we don't test for ZERO matches because we know we have them
+    # Note this is currently slow and will speed up when we cache the graph
+    print(" ".join(cmd))
+
+    # When we limit to MPI variant we might empty the match set
+    try:
+        o, e = run_command(cmd, quiet=True)
+    except:
+        return
+
+    # This runs unattended, so unexpected output is an error (not a shell)
+    if "Found matches" not in o:
+        raise RuntimeError(f"Unexpected output from {' '.join(cmd)}:\n{o}{e}".rstrip())
+
+    image = [x for x in o.split("\n") if x][-1]
+    print(f"compspec has selected {image}")
+    return image
+
+
+def artifact_cache_file(artifact, cache_path):
     """
-    # This time, we aren't selected from images (manifests)
-    # but rather starting with a base image (from reqs) and then using compspec
-    flux_view = req[args.platform]
-    selection = random.choice(flux_view)
-    container = selection["image"]
-    print(f"Selected flux view is {container}")
+    Get the file compspec caches an artifact URI to.
+    """
+    name = artifact.replace("/", "-").replace(":", "-")
+    return os.path.join(cache_path, f"{name}.json")
 
-    # Use a common cache so we don't stress the registry
+
+def get_attributes(compspec):
+    """
+    Flatten the attributes of a compspec (e.g., io.archspec.cpu.target).
+    """
+    attributes = {}
+    for group in compspec["compatibilities"]:
+        for key, value in group["attributes"].items():
+            attributes[f"{group['name']}.{key}"] = value
+    return attributes
+
+
+def load_match_index(manifest_file, cache_path, artifact_index=None):
+    """
+    Build an inverted index of compspec attributes to images.
+
+    Each attribute (e.g., io.archspec.cpu.target=amd64) maps to the set of
+    images that have it, so a match is an intersection of sets. We read the
+    same artifacts compspec writes to the cache (or their attributes from the
+    artifact cache index), and return None if any are missing (and compspec
+    needs to pull them).
+    """
+    index = {}
+    for image in load_yaml(manifest_file)["images"]:
+        digest = (artifact_index or {}).get("tags", {}).get(image["artifact"])
+        filename = artifact_cache_file(image["artifact"], cache_path)
+        if digest:
+            attributes = artifact_index["digests"][digest]["attributes"]
+        elif os.path.exists(filename):
+            attributes = get_attributes(read_json(filename))
+        else:
+            print(f"{filename} is not in the cache, falling back to compspec.")
+            return
+        for key, value in attributes.items():
+            index.setdefault(f"{key}={value}", set()).add(image["name"])
+    return index
+
+
+def artifact_blob_file(artifact_cache, digest):
+    """
+    Get the file for an artifact (compspec) in the artifact cache by digest.
+    """
+    algorithm, value = digest.split(":", 1)
+    return os.path.join(artifact_cache, "blobs", algorithm, f"{value}.json")
+
+
+def get_digest(content):
+    """
+    Get the (sha256) digest of artifact content.
+    """
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+def read_artifact_index(artifact_cache):
+    """
+    Read the artifact cache index.
+
+    The index maps artifact (image tag) to digest, and digest to the size,
+    last access, and attributes of the artifact.
+    """
+    filename = os.path.join(artifact_cache, "index.json")
+    if not os.path.exists(filename):
+        return {"tags": {}, "digests": {}}
+    return read_json(filename)
+
+
+def write_artifact_index(index, artifact_cache):
+    """
+    Write the artifact cache index (atomically, it is shared).
+    """
+    filename = os.path.join(artifact_cache, "index.json")
+    write_json(index, f"{filename}.tmp")
+    os.replace(f"{filename}.tmp", filename)
+
+
+def add_artifact(index, artifact_cache, artifact, content):
+    """
+    Add artifact content to the cache, and point the artifact tag at it.
+    """
+    digest = get_digest(content)
+    filename = artifact_blob_file(artifact_cache, digest)
+    if not os.path.exists(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(f"{filename}.tmp", "wb") as fd:
+            fd.write(content)
+        os.replace(f"{filename}.tmp", filename)
+    if digest not in index["digests"]:
+        index["digests"][digest] = {
+            "size": len(content),
+            "attributes": get_attributes(json.loads(content)),
+        }
+    index["digests"][digest]["accessed"] = time.time()
+    index["tags"][artifact] = digest
+    return digest
+
+
+def remove_digest(index, artifact_cache, digest):
+    """
+    Remove a digest (and tags that point to it) from the artifact cache.
+    """
+    filename = artifact_blob_file(artifact_cache, digest)
+    if os.path.exists(filename):
+        os.remove(filename)
+    index["digests"].pop(digest, None)
+    for tag in [x for x, y in index["tags"].items() if y == digest]:
+        del index["tags"][tag]
+
+
+def verify_artifact_cache(index, artifact_cache):
+    """
+    Verify every artifact in the cache has content that matches its digest.
+
+    Artifacts that are missing or don't match are removed, along with
+    digests that no tag points to anymore.
+    """
+    tagged = set(index["tags"].values())
+    for digest in list(index["digests"]):
+        filename = artifact_blob_file(artifact_cache, digest)
+        if digest not in tagged:
+            remove_digest(index, artifact_cache, digest)
+            continue
+        if not os.path.exists(filename):
+            print(f"Artifact {digest} is missing from the cache, removing.")
+            remove_digest(index, artifact_cache, digest)
+            continue
+        with open(filename, "rb") as fd:
+            if get_digest(fd.read()) != digest:
+                print(f"Artifact {digest} does not match its digest, removing.")
+                remove_digest(index, artifact_cache, digest)
+
+    # And tags that point to digests we don't have
+    for tag in [x for x, y in index["tags"].items() if y not in index["digests"]]:
+        del index["tags"][tag]
+
+
+def prune_artifact_cache(index, artifact_cache, max_size):
+    """
+    Remove the least recently used artifacts until the cache fits in max_size.
+    """
+    size = sum(x["size"] for x in index["digests"].values())
+    by_access = sorted(index["digests"], key=lambda x: index["digests"][x]["accessed"])
+    for digest in by_access:
+        if size <= max_size:
+            break
+        size -= index["digests"][digest]["size"]
+        remove_digest(index, artifact_cache, digest)
+
+
+def prune_compspec_cache(cache_path, max_size, keep):
+    """
+    Remove the least recently used artifacts from the compspec cache until it
+    fits in max_size, except for the artifacts (filenames) in keep.
+
+    A file is used when it is synced for a manifest (which updates its mtime).
+    """
+    entries = [x for x in os.scandir(cache_path) if x.name.endswith(".json")]
+    size = sum(x.stat().st_size for x in entries)
+    for entry in sorted(entries, key=lambda x: x.stat().st_mtime):
+        if size <= max_size:
+            break
+        if entry.path in keep:
+            continue
+        size -= entry.stat().st_size
+        os.remove(entry.path)
+
+
+def sync_artifact_cache(manifest_file, cache_path, artifact_cache, max_size=0):
+    """
+    Sync the compspec cache for the manifest images with the artifact cache.
+
+    Artifacts compspec pulled that the artifact cache doesn't have (new,
+    changed, or evicted before) are added to it by digest, and artifacts
+    compspec doesn't have yet are written from the artifact cache, so compspec
+    doesn't need to go to the registry for them. Only those count as a use of
+    the artifact cache. The artifact cache is verified first, and both caches
+    are pruned (least recently used) to max_size bytes after, if set. Returns
+    the index.
+    """
+    index = read_artifact_index(artifact_cache)
+    verify_artifact_cache(index, artifact_cache)
+    added = restored = 0
+    used = set()
+    for image in load_yaml(manifest_file)["images"]:
+        artifact = image["artifact"]
+        digest = index["tags"].get(artifact)
+        filename = artifact_cache_file(artifact, cache_path)
+        if os.path.exists(filename):
+            with open(filename, "rb") as fd:
+                content = fd.read()
+            if digest != get_digest(content):
+                add_artifact(index, artifact_cache, artifact, content)
+                added += 1
+            os.utime(filename)
+            used.add(filename)
+        elif digest:
+            shutil.copyfile(artifact_blob_file(artifact_cache, digest), filename)
+            index["digests"][digest]["accessed"] = time.time()
+            used.add(filename)
+            restored += 1
+    if max_size:
+        prune_artifact_cache(index, artifact_cache, max_size)
+        prune_compspec_cache(cache_path, max_size, used)
+    write_artifact_index(index, artifact_cache)
+    print(f"Artifact cache has {added} new and {restored} restored artifacts")
+    return index
+
+
+def match_images(index, matches):
+    """
+    Get the (sorted) images that have every attribute in matches.
+    """
+    sets = sorted([index.get(match, set()) for match in matches], key=len)
+    if not sets:
+        return []
+    return sorted(set.intersection(*sets))
+
+
+def get_cache_path(args):
+    """
+    Get (and create) the compspec cache directory.
+    """
     cache_path = os.path.join(args.outdir, "cache")
     if not os.path.exists(cache_path):
         os.makedirs(cache_path)
+    return cache_path
 
-    # Generate metadata based on labels for compspec
-    cmd = ["compspec", "match", "-i", manifest_file, "--cache", cache_path]
 
+def get_descriptive_matches(args, selection, mpi=False):
+    """
+    Get the attributes to match for a flux view, and the lammps executable.
+    """
     # Now add the labels to match
-    for key, value in selection["match"].items():
-        cmd += ["--match", f"{key}={value}"]
+    matches = [f"{key}={value}" for key, value in selection["match"].items()]
 
     if args.gpu:
-        cmd += ["--match", "org.supercontainers.hardware.gpu.available=yes"]
+        matches.append("org.supercontainers.hardware.gpu.available=yes")
         executable = "lmp_gpu"
     else:
-        cmd += ["--match", "org.supercontainers.hardware.gpu.available=no"]
+        matches.append("org.supercontainers.hardware.gpu.available=no")
         executable = "lmp"
 
     # Add in request for platform
     if args.platform == "amd64":
-        cmd += ["--match", "io.archspec.cpu.target=amd64"]
+        matches.append("io.archspec.cpu.target=amd64")
     else:
-        cmd += ["--match", "io.archspec.cpu.target=arm64"]
+        matches.append("io.archspec.cpu.target=arm64")
 
     # This might be the one glimpse of performance differences
     if mpi:
         if args.mode == "openmpi":
-            cmd += ["--match", "org.supercontainers.mpi.implementation=OpenMPI"]
+            matches.append("org.supercontainers.mpi.implementation=OpenMPI")
         elif args.mode == "mpich":
-            cmd += ["--match", "org.supercontainers.mpi.implementation=mpich"]
+            matches.append("org.supercontainers.mpi.implementation=mpich")
         elif args.mode == "intel-mpi":
-            cmd += ["--match", "org.supercontainers.mpi.implementation=intel-mpi"]
+            matches.append("org.supercontainers.mpi.implementation=intel-mpi")
+    return matches, executable
 
-    # We only want ONE match, and random selection
-    cmd += ["--single", "--randomize"]
 
-    # Run command to get matches
-    # Note we don't test for ZERO matches because we know we have them
-    # Note this is currently slow and will speed up when we cache the graph
-    print(" ".join(cmd))
+def get_feasible_views(args, manifest_file, mpi=False, index=None):
+    """
+    Get the flux views for the platform that have a non-empty match set.
 
-    # When we limit to MPI variant we might empty the match set
-    try:
-        o, e = run_command(cmd, quiet=True)
-    except:
-        return
+    The match set for a view only depends on the platform, mode, and gpu,
+    so we check each view once instead of retrying random views until one
+    matches. With the index this is free, otherwise it is one compspec call
+    per view.
+    """
+    cache_path = get_cache_path(args)
+    views = []
+    for selection in req[args.platform]:
+        matches, _ = get_descriptive_matches(args, selection, mpi)
+        if index is not None:
+            images = match_images(index, matches)
+        else:
+            images = [run_compspec_match(manifest_file, cache_path, matches)]
+        images = [x for x in images if x]
+        if images:
+            print(f"Flux view {selection['image']} has matches {' '.join(images)}")
+            views.append(selection)
+        else:
+            print(f"Flux view {selection['image']} has no matches, skipping.")
+    return views
 
-    if "Found matches" not in o:
-        print("Error with match, this should not happen, look at it.")
-        import IPython
 
-        IPython.embed()
+def generate_descriptive_minicluster(
+    args, manifest_file, cfg, name, mpi=False, index=None, views=None
+):
+    """
+    Generate a descriptive minicluster
 
-    image = [x for x in o.split("\n") if x][-1]
-    print(f"compspec has selected {image}")
+    For the descriptive case, we are going to run compspec (with a cache)
+    to do image selection for us, accounting for a specific operating system,
+    version (for glibc) and gpu (or most likely not to start - can be exposed later).
+    When mpi is true, use the args.mode to further filter down to an mpi variant.
+    We know mpich is better on Google Cloud. When an index is provided (from
+    load_match_index) we match in process instead of calling compspec, and
+    views (from get_feasible_views) limits the flux views to sample from.
+    """
+    # This time, we aren't selected from images (manifests)
+    # but rather starting with a base image (from reqs) and then using compspec
+    # We only sample from views known to have matches, when we have them.
+    flux_view = views or req[args.platform]
+    selection = random.choice(flux_view)
+    container = selection["image"]
+    print(f"Selected flux view is {container}")
+
+    # Use a common cache so we don't stress the registry
+    cache_path = get_cache_path(args)
+    matches, executable = get_descriptive_matches(args, selection, mpi)
+
+    # The in-process index gives the same match set without the subprocess
+    if index is not None:
+        images = match_images(index, matches)
+        print(f"Matching {' '.join(matches)}")
+        if not images:
+            return
+        image = random.choice(images)
+        print(f"index has selected {image}")
+    else:
+        image = run_compspec_match(manifest_file, cache_path, matches)
+        if not image:
+            return
 
     # For these, we assume the flux container is using ubuntu jammy
     # Note this can be changed
@@ -524,7 +1269,129 @@ def get_base_features(args, container):
     return features
 
 
-def run(args, config_name, outdir):
+def render_minicluster(args, manifests, cfg, name, index=None, views=None):
+    """
+    Generate the lammps job render based on experiment mode.
+    """
+    # basic is platform only, and static - wild west! Most will fail
+    if args.mode == "basic":
+        return generate_basic_minicluster(args, manifests, cfg, name)
+
+    # Match ubuntu to ubuntu and rocky to rocky, that's it
+    elif args.mode == "platform":
+        return generate_platform_minicluster(args, manifests, cfg, name)
+
+    # Same but account for version too (get rid of glibc errors0
+    elif args.mode == "platform-version":
+        return generate_platform_version_minicluster(args, manifests, cfg, name)
+
+    # descriptive also accounts for gpu
+    # Descriptive with an mpi mode!
+    render = None
+
+    # This is a huge limitation and we can empty the match set, but
+    # feasible views always have a match so this should not repeat
+    while not render:
+        render = generate_descriptive_minicluster(
+            args,
+            args.manifests,
+            cfg,
+            name,
+            mpi="mpi" in args.mode,
+            index=index,
+            views=views,
+        )
+    return render
+
+
+def run_minicluster(args, spec, minicluster_yaml, log_dir):
+    """
+    Submit one minicluster, wait for it to finish, and delete it.
+
+    Each minicluster is an independent task, so this is safe to run in a thread.
+    """
+    name = spec["params"]["name"]
+
+    # This submits the job, doesn't do more than that (e.g., waiting)
+    # Times are sub-second and monotonic, relative to this submit
+    spec["timestamps"] = {"submit": 0.0}
+    start_time = submit_job(minicluster_yaml)
+    spec["submitted_at"] = datetime.utcnow().isoformat()
+
+    # Get logs and wait for completion (or error). The minicluster is always
+    # deleted, so it doesn't hold on to nodes, and a timeout is a result.
+    try:
+        get_logs(
+            name,
+            spec,
+            start_time,
+            log_dir,
+            timeout=args.timeout,
+            backoff=args.backoff,
+            max_backoff=args.max_backoff,
+            detect=args.detect or bool(args.store),
+        )
+    except TimeoutError as e:
+        print(f"⏰️ {e}")
+        spec["result"] = "timeout"
+    except Exception as e:
+        print(f"❌️ Minicluster {name} failed: {e}")
+        spec["result"] = "error"
+        spec["error"] = str(e)
+    finally:
+        spec["total_wrapped_time"] = time.monotonic() - start_time
+        delete_minicluster(name)
+    spec["timestamps"]["deleted"] = time.monotonic() - start_time
+
+    # Record the result as soon as we have it, in case the run is interrupted
+    append_journal(spec, os.path.join(log_dir, "specs.jsonl"))
+    if args.store:
+        size = spec["params"]["size"]
+        gpu = spec["params"]["executable"] == "lmp_gpu"
+        record = {
+            "iter": spec["iter"],
+            "size": size,
+            "gpu": gpu,
+            "success": spec["result"] == "success",
+            "reason": spec["result"],
+            "wall_time": spec.get("wall_time"),
+            "total_wrapped_time": spec["total_wrapped_time"],
+        }
+        store_name = lammps_results.get_store_name(spec["iter"], size, gpu)
+        lammps_results.write_store(
+            [record], args.store, args.platform, args.mode, store_name
+        )
+    return spec
+
+
+def record_error(spec, error, log_dir):
+    """
+    Record a minicluster that failed with an error, so the sweep can continue.
+
+    The record is journaled with the error, and is run again on --resume.
+    """
+    print(f"❌️ Minicluster {spec['params']['name']} failed: {error}")
+    spec["result"] = "error"
+    spec["error"] = str(error)
+    append_journal(spec, os.path.join(log_dir, "specs.jsonl"))
+    return spec
+
+
+def get_max_inflight(args, cfgs, cluster_nodes=None):
+    """
+    Determine the number of miniclusters to keep running at once.
+    """
+    inflight = max(1, args.max_inflight)
+    if inflight == 1 or cluster_nodes is None:
+        return inflight
+    capacity = get_capacity(cluster_nodes, cfgs)
+    if capacity < inflight:
+        print(f"Cluster has capacity for {capacity} miniclusters, limiting to that.")
+        inflight = capacity
+    return inflight
+
+
+def run(args, config_name, outdir, cluster_nodes=None):
     """
     Run the experiments for a given experiment type.
     """
@@ -547,7 +1414,67 @@ def run(args, config_name, outdir):
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
-    for i in range(3, args.iters):
+    # Warm the image cache on every node so timed runs don't include pulls
+    if args.prepull:
+        prepull_images(args, manifests, outdir)
+
+    # Decide on the number of miniclusters running at once
+    inflight = get_max_inflight(args, cfgs, cluster_nodes)
+
+    # Each finished minicluster is appended to the journal. When we resume,
+    # we keep what is there and skip runs that are already done. Otherwise
+    # a previous journal is moved aside (never removed) and we start fresh.
+    journal = os.path.join(log_dir, "specs.jsonl")
+    completed = set()
+    if args.resume:
+        specs = [
+            x
+            for x in read_journal(journal)
+            if x.get("mode") == args.mode and "error" not in x
+        ]
+        completed = {(x["mode"], x["iter"], x["params"]["size"]) for x in specs}
+        print(f"Resuming with {len(completed)} completed runs from {journal}")
+    elif os.path.exists(journal):
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        rotated = f"{journal}.{stamp}"
+        os.rename(journal, rotated)
+        print(f"Moved previous journal to {rotated} (use --resume to continue it)")
+
+    # A shared artifact cache fills in the compspec cache, and learns from it
+    artifact_index = None
+    if args.artifact_cache and args.mode not in non_descriptive_modes:
+        artifact_index = sync_artifact_cache(
+            args.manifests,
+            get_cache_path(args),
+            args.artifact_cache,
+            args.artifact_cache_size * 1024 * 1024,
+        )
+
+    # The python matcher loads the manifests and cached artifacts once
+    index = None
+    if args.matcher == "python" and args.mode not in non_descriptive_modes:
+        index = load_match_index(
+            args.manifests, os.path.join(args.outdir, "cache"), artifact_index
+        )
+        if index is None and not shutil.which("compspec"):
+            sys.exit(
+                "The compspec cache is incomplete and compspec is not on the path."
+            )
+
+    # Check each flux view once, and exit right away if none can match
+    views = None
+    if args.mode not in non_descriptive_modes:
+        views = get_feasible_views(
+            args, args.manifests, mpi="mpi" in args.mode, index=index
+        )
+        if not views:
+            sys.exit(
+                f"No flux view for {args.platform} has images that match mode {args.mode}."
+            )
+
+    # Render all miniclusters up front - selection is random but independent
+    tasks = []
+    for i in range(args.iters):
 
         # Run 1 of each experiment size for lammps
         # note that we can change how we do this (random, etc)
@@ -556,45 +1483,15 @@ def run(args, config_name, outdir):
             # identifier for metadata
             size = cfg["size"]
             minicluster_name = f"lammps-{i}-size-{size}"
+            if (args.mode, i, size) in completed:
+                print(f"Skipping {minicluster_name}, already completed.")
+                continue
 
             # Generate the lammps job based on experiment mode
-
-            # basic is platform only, and static - wild west! Most will fail
-            if args.mode == "basic":
-                render = generate_basic_minicluster(
-                    args, manifests, cfg, minicluster_name
-                )
-
-            # Match ubuntu to ubuntu and rocky to rocky, that's it
-            elif args.mode == "platform":
-                render = generate_platform_minicluster(
-                    args, manifests, cfg, minicluster_name
-                )
-
-            # Same but account for version too (get rid of glibc errors0
-            elif args.mode == "platform-version":
-                render = generate_platform_version_minicluster(
-                    args, manifests, cfg, minicluster_name
-                )
-
-            # descriptive also accounts for gpu
-            # Descriptive with an mpi mode!
-            elif "mpi" in args.mode or args.mode == "descriptive-basic":
-                render = None
-
-                # This is a huge limitation and we can empty the match set
-                while not render:
-                    render = generate_descriptive_minicluster(
-                        args,
-                        args.manifests,
-                        cfg,
-                        minicluster_name,
-                        mpi="mpi" in args.mode,
-                    )
-
-            size = cfg["size"]
-            spec = {"params": render, "iter": i}
-            name = spec["params"]["name"]
+            render = render_minicluster(
+                args, manifests, cfg, minicluster_name, index=index, views=views
+            )
+            spec = {"params": render, "iter": i, "mode": args.mode}
 
             # Derive features (for later vector)
             spec["features"] = get_base_features(args, render["image"])
@@ -608,18 +1505,37 @@ def run(args, config_name, outdir):
                 log_dir, f"minicluster-{minicluster_name}.yaml"
             )
             write_file(minicluster_yaml, minicluster_yaml_file)
-
-            # This submits the job, doesn't do more than that (e.g., waiting)
-            start_time = datetime.utcnow()
-            submit_job(minicluster_yaml)
-
-            # Get logs and wait for completion (or error)
-            get_logs(minicluster_name, spec, start_time, log_dir)
-            end_time = datetime.utcnow()
-            spec["total_wrapped_time"] = (end_time - start_time).seconds
-            delete_minicluster(name)
+            tasks.append((spec, minicluster_yaml))
+
+    # The default (one at a time) does not need threads. Either way, a
+    # minicluster that fails is recorded and the rest still run.
+    if inflight == 1:
+        for spec, minicluster_yaml in tasks:
+            try:
+                spec = run_minicluster(args, spec, minicluster_yaml, log_dir)
+            except Exception as e:
+                spec = record_error(spec, e, log_dir)
             specs.append(spec)
 
+    else:
+        with ThreadPoolExecutor(max_workers=inflight) as executor:
+            futures = {
+                executor.submit(
+                    run_minicluster, args, spec, minicluster_yaml, log_dir
+                ): spec
+                for spec, minicluster_yaml in tasks
+            }
+            for future in as_completed(futures):
+                try:
+                    spec = future.result()
+                    print(f"✅️ Minicluster {spec['params']['name']} is complete.")
+                except Exception as e:
+                    spec = record_error(futures[future], e, log_dir)
+                specs.append(spec)
+
+    # Keep the same ordering as if we ran them one at a time (and fresh)
+    specs.sort(key=lambda x: x["iter"])
+
     print(f"🧪️ Experiments are finished. See output in {outdir}")
     write_json(specs, os.path.join(log_dir, "specs.json"))
 
@@ -688,6 +1604,69 @@ def get_parser():
         default=os.path.join(here, "results"),
         help="output directory for results",
     )
+    parser.add_argument(
+        "--max-inflight",
+        dest="max_inflight",
+        type=int,
+        default=1,
+        help="maximum number of miniclusters to run at once (defaults to 1)",
+    )
+    parser.add_argument(
+        "--matcher",
+        default="compspec",
+        choices=["compspec", "python"],
+        help="image matcher for descriptive modes (defaults to compspec)",
+    )
+    parser.add_argument(
+        "--artifact-cache",
+        dest="artifact_cache",
+        help="content-addressed cache of compspec artifacts to share across runs",
+    )
+    parser.add_argument(
+        "--artifact-cache-size",
+        dest="artifact_cache_size",
+        type=int,
+        default=0,
+        help="maximum size in MB of the artifact cache and compspec cache (defaults to 0, no limit)",
+    )
+    parser.add_argument(
+        "--detect",
+        action="store_true",
+        help="detect the result (success or known failure) as the log streams",
+    )
+    parser.add_argument(
+        "--store",
+        help="columnar (parquet) results store to add each run to (implies --detect)",
+    )
+    parser.add_argument(
+        "--prepull",
+        action="store_true",
+        help="pull all images for the platform to every node before timed runs",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip runs already recorded in the logs/specs.jsonl journal",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=0,
+        help="seconds to wait for a minicluster to finish (defaults to 0, no timeout)",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=1,
+        help="initial seconds to wait before retrying a Kubernetes API call (defaults to 1)",
+    )
+    parser.add_argument(
+        "--max-backoff",
+        dest="max_backoff",
+        type=float,
+        default=30,
+        help="maximum seconds to wait between retries (defaults to 30)",
+    )
     return parser
 
 
@@ -696,8 +1675,9 @@ def main():
     args, _ = parser.parse_known_args()
 
     # Ensure our template directory and templates exist
-    if not os.path.exists(lammps_template):
-        sys.exit(f"{lammps_template} does not exist.")
+    for template in [lammps_template, prepull_template]:
+        if not os.path.exists(template):
+            sys.exit(f"{template} does not exist.")
 
     outdir = os.path.abspath(args.outdir)
 
@@ -715,7 +1695,7 @@ def main():
         sys.exit(f"{args.config_name} is not a known configuration")
 
     compspec = None
-    if args.mode.startswith("descriptive"):
+    if args.mode.startswith("descriptive") and args.matcher == "compspec":
         compspec = shutil.which("compspec")
         if not compspec:
             sys.exit(
@@ -728,6 +1708,7 @@ def main():
     print(f"▶️        Iterations: {args.iters}")
     print(f"▶️          Platform: {args.platform}")
     print(f"▶️              Mode: {args.mode}")
+    print(f"▶️      Max inflight: {args.max_inflight}")
 
     # kubectl create -f cfg/service.yaml
     # kubectl create -f cfg/rbac.yaml
@@ -739,10 +1720,10 @@ def main():
     topology_file = os.path.join(outdir, "topology.json")
 
     # Write cluster node configuration and return mapping
-    save_nodes(topology_file)
+    cluster_nodes = save_nodes(topology_file)
 
     try:
-        run(args, args.config_name, outdir)
+        run(args, args.config_name, outdir, cluster_nodes)
     except Exception as e:
         print(e)
         raise
@@ -1,15 +1,43 @@
 #!/usr/bin/env python3
 
 import argparse
+import copy
+import hashlib
 import json
 import os
 import rainbow.jobspec.converter as converter
 import yaml
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 here = os.path.dirname(os.path.abspath(__file__))
 root = os.path.dirname(here)
 
+# Use the libyaml (C) dumper when it is available, it is much faster
+Dumper = getattr(yaml, "CDumper", yaml.Dumper)
+
+# These are the levels (and associated groups we include for each)
+# A lookup of the attributes we care about for each level
+levels = {
+    "platform": {"io.archspec": ["cpu.target"]},
+    "os": {"io.archspec": ["cpu.target"], "os": ["os.name", "os.vendor"]},
+    "os-version": {
+        "io.archspec": ["cpu.target"],
+        "os": ["os.name", "os.vendor", "os.release"],
+    },
+    "descriptive": {
+        "io.archspec": ["cpu.target"],
+        "hardware": ["hardware.gpu.available"],
+        "os": ["os.name", "os.release", "os.vendor"],
+    },
+    "mpi": {
+        "io.archspec": ["cpu.target"],
+        "hardware": ["hardware.gpu.available"],
+        "os": ["os.name", "os.release", "os.vendor"],
+        "mpi": ["mpi.implementation", "mpi.version"],
+    },
+}
+
 
 def recursive_find(base, pattern="^(compspec[.]json)$"):
     """
@@ -46,12 +74,135 @@ def load_yaml(filename):
     return content
 
 
+def content_hash(content):
+    """
+    Get the sha256 digest of some content
+    """
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
 def write_yaml(data, filename):
     """
-    Write yaml to file
+    Write yaml to file, unless it already has the same content.
+
+    Returns True if the file was written.
     """
+    content = yaml.dump(data, Dumper=Dumper)
+    if os.path.exists(filename):
+        if content_hash(read_file(filename)) == content_hash(content):
+            return False
     with open(filename, "w") as outfile:
-        yaml.dump(data, outfile)
+        outfile.write(content)
+    return True
+
+
+def load_levels(filename):
+    """
+    Load compatibility levels from a yaml (or json) config file.
+
+    Each level is a lookup of group to attributes, like levels above. A level
+    can also extend one or more other levels to include their attributes,
+    so a lattice of levels doesn't need to repeat them.
+    """
+    config = load_yaml(filename)
+    resolved = {}
+
+    def resolve(level, seen):
+        if level in resolved:
+            return resolved[level]
+        if level in seen:
+            raise ValueError(f"Level {level} extends itself")
+        if level not in config:
+            raise ValueError(f"Level {level} is not defined in {filename}")
+        spec = dict(config[level])
+        parents = spec.pop("extends", [])
+        if isinstance(parents, str):
+            parents = [parents]
+        attributes = {}
+        for lookup in [resolve(x, seen + [level]) for x in parents] + [spec]:
+            for group, names in lookup.items():
+                if group not in attributes:
+                    attributes[group] = []
+                attributes[group] += [x for x in names if x not in attributes[group]]
+        resolved[level] = attributes
+        return attributes
+
+    return {level: resolve(level, []) for level in config}
+
+
+def flatten_compspec(compspec):
+    """
+    Flatten a compspec into a lookup of group to attributes (and values).
+    """
+    flat = {}
+    for compatibility in compspec["compatibilities"]:
+        if compatibility["name"] not in flat:
+            flat[compatibility["name"]] = {}
+        flat[compatibility["name"]].update(compatibility["attributes"])
+    return flat
+
+
+def map_compspec_groups(compspec, levels):
+    """
+    Move attributes of a compspec into the groups the levels expect.
+
+    Artifacts (e.g., from the artifact cache) can have attributes for several
+    subsystems in one group (org.supercontainers has os.*, mpi.*, hardware.*),
+    so an attribute that is not in a level group goes to the level group that
+    asks for it by name, or that matches its prefix (os.version goes to os).
+    """
+    groups = {}
+    for attributes in levels.values():
+        for group, names in attributes.items():
+            groups.update({x: group for x in names})
+    named = set(groups.values())
+
+    compatibilities = {}
+    for compatibility in compspec["compatibilities"]:
+        for key, value in compatibility["attributes"].items():
+            group = compatibility["name"]
+            if group not in named:
+                group = groups.get(key, key.split(".", 1)[0])
+                group = group if group in named else compatibility["name"]
+            if group not in compatibilities:
+                compatibilities[group] = {
+                    "name": group,
+                    "version": compatibility["version"],
+                    "attributes": {},
+                }
+            compatibilities[group]["attributes"][key] = value
+    compspec = copy.deepcopy(compspec)
+    compspec["compatibilities"] = list(compatibilities.values())
+    return compspec
+
+
+def derive_jobspec(template, flat, attributes, name):
+    """
+    Derive the jobspec for a level from the jobspec for all levels.
+
+    The template jobspec has the resources and tasks, and we only need to
+    set the attributes (task resources) for the level and its name.
+    """
+    js = copy.deepcopy(template)
+    resources = {}
+    for group, names in attributes.items():
+        for attribute in names:
+            if attribute in flat.get(group, {}):
+                if group not in resources:
+                    resources[group] = {}
+                resources[group][attribute] = flat[group][attribute]
+    for task in js["tasks"]:
+        task["resources"] = copy.deepcopy(resources)
+        task["slot"] = name
+
+    # The slot (label) is named for the level
+    resources = list(js["resources"])
+    while resources:
+        resource = resources.pop()
+        if resource["type"] == "slot":
+            resource["label"] = name
+        resources += resource.get("with", [])
+    return js
 
 
 def get_parser():
@@ -78,9 +229,76 @@ def get_parser():
         default=4,
         help="number of tasks (processes) the application will need",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes to generate jobspecs (defaults to python's choice)",
+    )
+    parser.add_argument(
+        "--cache",
+        help="artifact cache to read compspecs from instead of the input directory",
+    )
+    parser.add_argument(
+        "--levels",
+        help="yaml or json file of compatibility levels (defaults to platform, os, os-version, descriptive, mpi)",
+    )
     return parser
 
 
+def load_cache(cache):
+    """
+    Load compspecs from an artifact cache (run_experiments.py --artifact-cache).
+
+    Returns a list of (blob file, compspec name) for each artifact tag, where
+    the name is the same -compspec.json name compspec caches the artifact to.
+    Blobs that are missing or don't match their digest are skipped.
+    """
+    index = read_json(os.path.join(cache, "index.json"))
+    inputs = []
+    for artifact, digest in sorted(index["tags"].items()):
+        algorithm, value = digest.split(":", 1)
+        filename = os.path.join(cache, "blobs", algorithm, f"{value}.json")
+        if not os.path.exists(filename):
+            print(f"Artifact {artifact} is missing from the cache, skipping.")
+            continue
+        with open(filename, "rb") as fd:
+            if "sha256:" + hashlib.sha256(fd.read()).hexdigest() != digest:
+                print(f"Artifact {artifact} does not match its digest, skipping.")
+                continue
+        name = artifact.replace("/", "-").replace(":", "-")
+        if not name.endswith("-compspec"):
+            name = f"{name}-compspec"
+        inputs.append((filename, f"{name}.json"))
+    return inputs
+
+
+def check_cache(inputs, indir, levels):
+    """
+    Check compspecs from the artifact cache against the same in the input directory.
+
+    For each level, the attributes a jobspec would get should be the same.
+    Returns the names of compspecs that differ.
+    """
+    found = {os.path.basename(x): x for x in recursive_find(indir, ".+compspec[.]json")}
+    differ = []
+    for filename, name in inputs:
+        if name not in found:
+            continue
+        cached = flatten_compspec(map_compspec_groups(read_json(filename), levels))
+        local = flatten_compspec(map_compspec_groups(read_json(found[name]), levels))
+        for attributes in levels.values():
+            for group, names in attributes.items():
+                if any(
+                    cached.get(group, {}).get(x) != local.get(group, {}).get(x)
+                    for x in names
+                ):
+                    differ.append(name)
+    differ = sorted(set(differ))
+    for name in differ:
+        print(f"Artifact for {name} has different attributes than {found[name]}")
+    return differ
+
+
 def compspec_file_to_jobspec_file(filename):
     """
     Convert the compspec.json to a jobspec yaml name
@@ -99,68 +317,85 @@ def main():
 
     # Show parameters to the user
     print(f"▶️  Output directory: {args.outdir}")
-    print(f"▶️   Input directory: {args.indir}")
-
-    # These are the levels (and associated groups we include for each)
-    # A lookup of the attributes we care about for each level
-    levels = {
-        "platform": {"io.archspec": ["cpu.target"]},
-        "os": {"io.archspec": ["cpu.target"], "os": ["os.name", "os.vendor"]},
-        "os-version": {
-            "io.archspec": ["cpu.target"],
-            "os": ["os.name", "os.vendor", "os.release"],
-        },
-        "descriptive": {
-            "io.archspec": ["cpu.target"],
-            "hardware": ["hardware.gpu.available"],
-            "os": ["os.name", "os.release", "os.vendor"],
-        },
-        "mpi": {
-            "io.archspec": ["cpu.target"],
-            "hardware": ["hardware.gpu.available"],
-            "os": ["os.name", "os.release", "os.vendor"],
-            "mpi": ["mpi.implementation", "mpi.version"],
-        },
-    }
-    inputs = recursive_find(args.indir, ".+compspec[.]json")
-    for input_file in inputs:
-        # We need to generate a jobspec for each compatibility level.
-        compspec = read_json(input_file)
-        command = [
-            "lmp",
-            "-v",
-            "x",
-            "2",
-            "-v",
-            "y",
-            "2",
-            "-v",
-            "z",
-            "2",
-            "-in",
-            "./in.reaxff.hns",
-            "-nocite",
-        ]
-        if "gpu" in input_file:
-            command[0] = "lmp_gpu"
-
-        # Generate a jobspec for each level
-        for level, attributes in levels.items():
-            js = converter.from_compatibility_spec(
-                compspec,
-                command,
-                args.nodes,
-                tasks=args.tasks,
-                name=f"lammps-{level}",
-                attributes=attributes,
-            )
-            outdir = os.path.join(args.outdir, level)
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
-            outfile = compspec_file_to_jobspec_file(input_file)
-            outfile = os.path.join(outdir, outfile)
+    print(f"▶️   Input directory: {args.cache or args.indir}")
+
+    # Levels can also be declared in a config file
+    args.levels = load_levels(args.levels) if args.levels else levels
+    print(f"▶️            Levels: {' '.join(args.levels)}")
+
+    # Jobspecs for each compspec are independent, so generate them in processes
+    if args.cache:
+        cached = load_cache(args.cache)
+        check_cache(cached, args.indir, args.levels)
+        inputs, names = list(zip(*cached)) or ([], [])
+    else:
+        inputs = names = list(recursive_find(args.indir, ".+compspec[.]json"))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        written = sum(
+            executor.map(generate_jobspecs, inputs, [args] * len(inputs), names)
+        )
+    total = len(inputs) * len(args.levels)
+    print(f"Wrote {written} jobspecs ({total - written} unchanged)")
+
+
+def generate_jobspecs(input_file, args, name=None):
+    """
+    Generate a jobspec for each compatibility level for a compspec.
+
+    The name of the compspec (defaults to the input file) names the jobspecs.
+    Returns the number of jobspecs written (that changed).
+    """
+    name = name or input_file
+    # We need to generate a jobspec for each compatibility level.
+    compspec = map_compspec_groups(read_json(input_file), args.levels)
+    command = [
+        "lmp",
+        "-v",
+        "x",
+        "2",
+        "-v",
+        "y",
+        "2",
+        "-v",
+        "z",
+        "2",
+        "-in",
+        "./in.reaxff.hns",
+        "-nocite",
+    ]
+    if "gpu" in name:
+        command[0] = "lmp_gpu"
+
+    # Generate one jobspec with the attributes of all levels, and the
+    # flattened compspec, and derive the jobspec for each level from them
+    union = {}
+    for attributes in args.levels.values():
+        for group, names in attributes.items():
+            union[group] = union.get(group, []) + [
+                x for x in names if x not in union.get(group, [])
+            ]
+    template = converter.from_compatibility_spec(
+        compspec,
+        command,
+        args.nodes,
+        tasks=args.tasks,
+        name="lammps",
+        attributes=union,
+    )
+    flat = flatten_compspec(compspec)
+
+    # Generate a jobspec for each level
+    written = 0
+    for level, attributes in args.levels.items():
+        js = derive_jobspec(template, flat, attributes, f"lammps-{level}")
+        outdir = os.path.join(args.outdir, level)
+        os.makedirs(outdir, exist_ok=True)
+        outfile = compspec_file_to_jobspec_file(name)
+        outfile = os.path.join(outdir, outfile)
+        if write_yaml(js, outfile):
             print(f"Writing {level} jobspec {os.path.basename(outfile)}")
-            write_yaml(js, outfile)
+            written += 1
+    return written
 
 
 if __name__ == "__main__":
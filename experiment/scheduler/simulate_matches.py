@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import re
+import yaml
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Use the libyaml (C) loader when it is available, it is much faster
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Compatibility levels of jobspecs, from least to most descriptive
+levels = ["platform", "os", "os-version", "descriptive", "mpi"]
+
+
+def recursive_find(base, pattern):
+    """
+    Recursively find files that match a pattern.
+    """
+    for root, _, filenames in os.walk(base):
+        for filename in filenames:
+            if re.search(pattern, filename):
+                yield os.path.join(root, filename)
+
+
+def read_json(filename):
+    """
+    Read json from file
+    """
+    return json.loads(read_file(filename))
+
+
+def read_file(filename):
+    """
+    Read content from file
+    """
+    with open(filename, "r") as fd:
+        content = fd.read()
+    return content
+
+
+def write_json(content, filename):
+    """
+    Write json to file
+    """
+    with open(filename, "w") as fd:
+        fd.write(json.dumps(content, indent=4))
+
+
+def load_yaml(filename):
+    """
+    Read yaml from file.
+    """
+    with open(filename, "r") as stream:
+        content = yaml.load(stream, Loader=Loader)
+    return content
+
+
+def get_requirements(jobspec):
+    """
+    Get the nodes and subsystem attributes (requirements) for a jobspec.
+
+    Requirements are (subsystem, attribute, value) with values as strings,
+    and the nodes are the count of the top level node resources.
+    """
+    nodes = sum(x["count"] for x in jobspec["resources"] if x["type"] == "node")
+    requires = set()
+    for task in jobspec["tasks"]:
+        for subsystem, attributes in task.get("resources", {}).items():
+            for name, value in attributes.items():
+                requires.add((subsystem, name, str(value)))
+    return max(nodes, 1), frozenset(requires)
+
+
+def load_jobspecs(jobspecs_dir):
+    """
+    Load requirements of jobspecs, organized by level and then jobspec name.
+    """
+    # Levels from a config file (generate_jobspecs.py --levels) come after ours
+    found = [x for x in sorted(os.listdir(jobspecs_dir)) if x not in levels]
+    jobspecs = {}
+    for level in levels + found:
+        level_dir = os.path.join(jobspecs_dir, level)
+        if not os.path.isdir(level_dir):
+            continue
+        jobspecs[level] = {}
+        for filename in sorted(recursive_find(level_dir, "jobspec[.]yaml$")):
+            name = os.path.basename(filename).replace("-jobspec.yaml", "")
+            jobspecs[level][name] = get_requirements(load_yaml(filename))
+    return jobspecs
+
+
+def index_clusters(clusters_dir):
+    """
+    Index the nodes of each cluster by the subsystem attributes they have.
+
+    Each node of a cluster is a bit, and the index is a lookup of
+    (subsystem, attribute, value) to the cluster to a mask of its nodes
+    that have it. Matching is then a few AND operations per cluster.
+    """
+    index = {}
+    clusters = []
+    for filename in sorted(recursive_find(clusters_dir, "^subsystems[.]json$")):
+        cluster = os.path.basename(os.path.dirname(filename))
+        clusters.append(cluster)
+        graph = read_json(filename)["graph"]
+
+        # Node vertices get a bit, and subsystem vertices are found by edge
+        bits = {}
+        for key, vertex in graph["nodes"].items():
+            if vertex["metadata"]["type"] == "node":
+                bits[key] = 1 << len(bits)
+        for edge in graph["edges"]:
+            if "subsystem" not in edge["metadata"] or edge["source"] not in bits:
+                continue
+            vertex = graph["nodes"][edge["target"]]
+            subsystem = edge["metadata"]["subsystem"]
+            for name, value in vertex["metadata"].get("attributes", {}).items():
+                key = (subsystem, name, str(value))
+                if key not in index:
+                    index[key] = {}
+                index[key][cluster] = index[key].get(cluster, 0) | bits[edge["source"]]
+    return index, clusters
+
+
+def match_clusters(index, clusters, nodes, requires):
+    """
+    Get the clusters with enough nodes that have all the requirements.
+
+    Returns a lookup of cluster to the number of matching nodes.
+    """
+    masks = {cluster: -1 for cluster in clusters}
+    for key in requires:
+        found = index.get(key, {})
+        masks = {c: mask & found[c] for c, mask in masks.items() if c in found}
+        if not masks:
+            break
+    matches = {}
+    for cluster, mask in masks.items():
+        count = bin(mask).count("1") if requires else nodes
+        if count >= nodes:
+            matches[cluster] = count
+    return matches
+
+
+def select_cluster(matches, policy):
+    """
+    Select a cluster from matches with a policy.
+    """
+    if not matches:
+        return None
+    if policy == "first":
+        return sorted(matches)[0]
+    if policy == "most-nodes":
+        return sorted(matches, key=lambda x: (-matches[x], x))[0]
+    return random.choice(sorted(matches))
+
+
+def run(args, outdir):
+    """
+    Match jobspecs at each level to clusters and assess the selection.
+    """
+    jobspecs = load_jobspecs(args.jobspecs)
+    index, clusters = index_clusters(args.clusters)
+    print(f"Found {len(clusters)} clusters: {' '.join(clusters)}")
+    if args.truth not in jobspecs:
+        raise ValueError(f"There are no jobspecs for the truth level {args.truth}")
+
+    # Jobspecs with the same requirements have the same matches
+    cache = {}
+
+    def get_matches(nodes, requires):
+        if (nodes, requires) not in cache:
+            cache[(nodes, requires)] = match_clusters(index, clusters, nodes, requires)
+        return cache[(nodes, requires)]
+
+    # The truth is where the most descriptive jobspec can run
+    truth = {
+        name: sorted(get_matches(*requires))
+        for name, requires in jobspecs[args.truth].items()
+    }
+
+    results = {}
+    for level, specs in jobspecs.items():
+        results[level] = {}
+        correct = total = 0
+        for name, requires in specs.items():
+            matches = get_matches(*requires)
+            needed = truth.get(name, [])
+            results[level][name] = {"matches": sorted(matches), "truth": needed}
+            results[level][name]["selected"] = []
+            for _ in range(args.iters):
+                choice = select_cluster(matches, args.policy)
+                is_correct = choice in needed if needed else choice is None
+                results[level][name]["selected"].append(
+                    {"selected": choice, "correct": is_correct}
+                )
+                correct += is_correct
+                total += 1
+        accuracy = correct / total if total else 0
+        print(f"🧪️ {level}: accuracy {accuracy:.3f} for {len(specs)} jobspecs")
+
+    write_json(results, os.path.join(outdir, "match-results.json"))
+    print(f"Matches are finished. See output in {outdir}")
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Simulate rainbow cluster selection for jobspecs"
+    )
+    parser.add_argument(
+        "--jobspecs",
+        default=os.path.join(here, "jobspecs"),
+        help="directory with a subdirectory of jobspecs for each level",
+    )
+    parser.add_argument(
+        "--clusters",
+        default=os.path.join(here, "subsystems", "clusters"),
+        help="directory with <cluster>/subsystems.json graphs",
+    )
+    parser.add_argument(
+        "--outdir",
+        default=os.path.join(here, "results"),
+        help="output directory for results",
+    )
+    parser.add_argument(
+        "--policy",
+        default="random",
+        choices=["random", "first", "most-nodes"],
+        help="policy to select a cluster from matches (defaults to random)",
+    )
+    parser.add_argument(
+        "--truth",
+        default="mpi",
+        help="level of jobspecs that decides where a jobspec can run (defaults to mpi)",
+    )
+    parser.add_argument(
+        "--iters",
+        default=20,
+        help="number of selections to make for each jobspec",
+        type=int,
+    )
+    parser.add_argument(
+        "--seed",
+        help="seed for the random policy, to repeat a simulation",
+        type=int,
+    )
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args, _ = parser.parse_known_args()
+    outdir = os.path.abspath(args.outdir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    # Show parameters to the user
+    print(f"▶️  Output directory: {outdir}")
+    print(f"▶️          Jobspecs: {args.jobspecs}")
+    print(f"▶️          Clusters: {args.clusters}")
+    print(f"▶️            Policy: {args.policy}")
+    if args.seed is not None:
+        random.seed(args.seed)
+    run(args, outdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import itertools
 import json
 import os
-import rainbow.jobspec.converter as converter
 import yaml
 import re
 
 here = os.path.dirname(os.path.abspath(__file__))
-root = os.path.dirname(here)
 
+# Vertex metadata fields of a cluster (containment) graph, in order
+vertex_fields = (
+    "basename",
+    "exclusive",
+    "id",
+    "name",
+    "paths",
+    "rank",
+    "size",
+    "type",
+    "uniq_id",
+    "unit",
+)
 
-def recursive_find(base, pattern="^(compspec[.]json)$"):
+
+def recursive_find(base, pattern="^(node[.]yaml)$"):
     """
-    Recursively find lammps output files.
+    Recursively find node subsystem metadata files.
     """
     for root, _, filenames in os.walk(base):
         for filename in filenames:
@@ -46,121 +60,480 @@ def load_yaml(filename):
     return content
 
 
-def write_yaml(data, filename):
+def read_subsystems(filename):
     """
-    Write yaml to file
+    Read subsystem metadata for a node from a node.yaml or compspec.json.
+
+    Either way, we return a lookup of subsystem (e.g., mpi) to attributes.
     """
-    with open(filename, "w") as outfile:
-        yaml.dump(data, outfile)
+    if filename.endswith(".json"):
+        compspec = read_json(filename)
+        return {x["name"]: x["attributes"] for x in compspec["compatibilities"]}
+    return load_yaml(filename)["node"]["subsystems"]
 
 
 def get_parser():
-    parser = argparse.ArgumentParser(description="compspec to jobspec generator")
+    parser = argparse.ArgumentParser(description="subsystem graph (JGF) generator")
     parser.add_argument(
-        "--indir",
-        default=here,
-        help="Input directory with *compspec.json",
+        "--cluster",
+        default=os.path.join(here, "cluster-nodes.json"),
+        help="cluster (containment) graph in JSON graph format",
     )
     parser.add_argument(
-        "--outdir",
-        default=os.path.join(root, "jobspecs"),
-        help="output directory for jobspecs",
+        "--indir",
+        default=os.path.join(here, "clusters"),
+        help="Input directory with <cluster>/node.yaml",
     )
     parser.add_argument(
-        "--nodes",
-        type=int,
-        default=2,
-        help="number of nodes the application will run on",
+        "--node",
+        help="node.yaml or compspec.json for a single cluster (instead of --indir)",
     )
     parser.add_argument(
-        "--tasks",
-        type=int,
-        default=4,
-        help="number of tasks (processes) the application will need",
+        "--out",
+        help="output graph for --node (defaults to subsystems.json alongside it)",
     )
     return parser
 
 
-def compspec_file_to_jobspec_file(filename):
+def new_graph():
+    """
+    Create an empty compact graph.
+
+    Vertices and edges are stored in columns (arrays) instead of dicts.
+    Repeated strings (basename, type, unit, path name, relation) are interned
+    once in a string table that the columns index into. Anything that can be
+    derived (the label, name and path) is not stored, and a vertex or edge
+    that doesn't fit the columns is kept as is.
+    """
+    return {
+        "content": {},
+        "strings": [],
+        "codes": {},
+        # Vertex columns
+        "basename": array.array("i"),
+        "type": array.array("i"),
+        "unit": array.array("i"),
+        "id": array.array("q"),
+        "exclusive": array.array("b"),
+        "rank": array.array("q"),
+        "size": array.array("q"),
+        "uniq_id": array.array("q"),
+        "parent": array.array("q"),
+        "path_name": array.array("i"),
+        # Edge columns
+        "source": array.array("q"),
+        "target": array.array("q"),
+        "relation": array.array("i"),
+        # Vertices and edges (or parts of) that don't fit the columns
+        "vertices": {},
+        "keys": {},
+        "paths": {},
+        "attributes": {},
+        "int_ids": set(),
+        "edges": {},
+        "edge_metadata": {},
+    }
+
+
+def intern_string(graph, value):
+    """
+    Get the code for a string in the graph string table.
+    """
+    code = graph["codes"].get(value)
+    if code is None:
+        code = graph["codes"][value] = len(graph["strings"])
+        graph["strings"].append(value)
+    return code
+
+
+def is_compact_vertex(vertex):
+    """
+    Determine if a vertex can be stored in the columns of a compact graph.
+
+    Subsystem vertices (with attributes, and a path named for the subsystem)
+    fit too, with their attributes kept aside.
+    """
+    if list(vertex) != ["label", "metadata"]:
+        return False
+    meta = vertex["metadata"]
+    if tuple(meta) not in [vertex_fields, ("attributes",) + vertex_fields]:
+        return False
+    if not isinstance(meta["paths"], dict) or len(meta["paths"]) != 1:
+        return False
+    if not all(isinstance(x, str) for x in meta["paths"].values()):
+        return False
+    if type(meta["id"]) != int and (
+        not isinstance(meta["id"], str)
+        or not re.fullmatch("0|-?[1-9][0-9]*", meta["id"])
+    ):
+        return False
+    if not all(isinstance(meta[x], str) for x in ["basename", "type", "unit"]):
+        return False
+    if not all(type(meta[x]) == int for x in ["rank", "size", "uniq_id"]):
+        return False
+    return (
+        isinstance(meta["exclusive"], bool)
+        and vertex["label"] == str(meta["uniq_id"])
+        and meta["name"] == meta["basename"] + str(meta["id"])
+    )
+
+
+def add_vertex(graph, vertex, paths):
+    """
+    Add a vertex to a compact graph, and return its index.
+    """
+    index = len(graph["uniq_id"])
+    if is_compact_vertex(vertex):
+        meta = vertex["metadata"]
+        graph["basename"].append(intern_string(graph, meta["basename"]))
+        graph["type"].append(intern_string(graph, meta["type"]))
+        graph["unit"].append(intern_string(graph, meta["unit"]))
+        graph["id"].append(int(meta["id"]))
+        if isinstance(meta["id"], int):
+            graph["int_ids"].add(index)
+        graph["exclusive"].append(meta["exclusive"])
+        graph["rank"].append(meta["rank"])
+        graph["size"].append(meta["size"])
+        graph["uniq_id"].append(meta["uniq_id"])
+        [(path_name, path)] = meta["paths"].items()
+        graph["path_name"].append(intern_string(graph, path_name))
+        paths.append(path)
+        if "attributes" in meta:
+            graph["attributes"][index] = meta["attributes"]
+    else:
+        graph["vertices"][index] = vertex
+        for name in ["basename", "type", "unit", "id", "exclusive", "path_name"]:
+            graph[name].append(0)
+        for name in ["rank", "size", "uniq_id"]:
+            graph[name].append(-1)
+        paths.append(None)
+    graph["parent"].append(-1)
+    return index
+
+
+def add_edge(graph, edge, ends):
+    """
+    Add an edge to a compact graph, and return its index.
+
+    The source and target are resolved to vertex indices after loading.
+    """
+    index = len(graph["relation"])
+    if list(edge) == ["source", "target", "relation", "metadata"] and isinstance(
+        edge["relation"], str
+    ):
+        graph["relation"].append(intern_string(graph, edge["relation"]))
+        ends.append((edge["source"], edge["target"]))
+        if edge["metadata"] != {}:
+            graph["edge_metadata"][index] = edge["metadata"]
+    else:
+        graph["edges"][index] = edge
+        graph["relation"].append(-1)
+        ends.append(None)
+    return index
+
+
+def load_graph(filename):
+    """
+    Load a JSON graph format (JGF) cluster graph into a compact graph.
+
+    Vertices and edges are added as they are parsed (with an object hook)
+    so the full graph of dicts is never held in memory.
+    """
+    graph = new_graph()
+    paths = []
+    ends = []
+
+    def add_object(obj):
+        if "label" in obj and "metadata" in obj and "nodes" not in obj:
+            return add_vertex(graph, obj, paths)
+        if "source" in obj and "target" in obj and "relation" in obj:
+            return add_edge(graph, obj, ends)
+        return obj
+
+    with open(filename, "r") as fd:
+        content = json.load(fd, object_hook=add_object)
+
+    # Keep everything but nodes and edges (e.g., directed) in order
+    graph["content"] = content
+    nodes = content["graph"]["nodes"]
+    lookup = {}
+    for key, index in nodes.items():
+        lookup[key] = index
+        if index in graph["vertices"] or key != str(graph["uniq_id"][index]):
+            graph["keys"][index] = key
+    content["graph"]["nodes"] = None
+    content["graph"]["edges"] = None
+
+    # Resolve edges to vertices, and containment edges to parents
+    contains = graph["codes"].get("contains")
+    for index, end in enumerate(ends):
+        if end is None or end[0] not in lookup or end[1] not in lookup:
+            if end is not None:
+                graph["edges"][index] = get_edge(graph, index, *end)
+            graph["source"].append(-1)
+            graph["target"].append(-1)
+            continue
+        source, target = lookup[end[0]], lookup[end[1]]
+        graph["source"].append(source)
+        graph["target"].append(target)
+        if graph["relation"][index] == contains and graph["parent"][target] == -1:
+            graph["parent"][target] = source
+
+    # Only keep containment paths we can't derive from parents
+    for index, path in enumerate(paths):
+        if path is not None and get_path(graph, index) != path:
+            graph["paths"][index] = path
+    return graph
+
+
+def get_key(graph, index):
+    """
+    Get the key of a vertex in the nodes of the graph.
+    """
+    return graph["keys"].get(index) or str(graph["uniq_id"][index])
+
+
+def get_path(graph, index):
+    """
+    Get the containment path of a vertex, derived from its parents.
+    """
+    if index in graph["paths"]:
+        return graph["paths"][index]
+    if index in graph["vertices"]:
+        return graph["vertices"][index]["metadata"].get("paths", {}).get("containment")
+    parent = graph["parent"][index]
+    prefix = get_path(graph, parent) if parent != -1 else ""
+    if prefix is None:
+        return None
+    name = graph["strings"][graph["basename"][index]] + str(graph["id"][index])
+    return f"{prefix}/{name}"
+
+
+def get_vertex(graph, index, path=None):
+    """
+    Get a vertex of a compact graph as JGF.
+    """
+    if index in graph["vertices"]:
+        return graph["vertices"][index]
+    if path is None:
+        path = get_path(graph, index)
+    strings = graph["strings"]
+    basename = strings[graph["basename"][index]]
+    vertex_id = graph["id"][index]
+    meta = {}
+    if index in graph["attributes"]:
+        meta["attributes"] = graph["attributes"][index]
+    meta.update(
+        {
+            "basename": basename,
+            "exclusive": bool(graph["exclusive"][index]),
+            "id": vertex_id if index in graph["int_ids"] else str(vertex_id),
+            "name": basename + str(vertex_id),
+            "paths": {strings[graph["path_name"][index]]: path},
+            "rank": graph["rank"][index],
+            "size": graph["size"][index],
+            "type": strings[graph["type"][index]],
+            "uniq_id": graph["uniq_id"][index],
+            "unit": strings[graph["unit"][index]],
+        }
+    )
+    return {"label": str(graph["uniq_id"][index]), "metadata": meta}
+
+
+def get_edge(graph, index, source, target):
     """
-    Convert the compspec.json to a jobspec yaml name
+    Get an edge of a compact graph as JGF, given the keys of its ends.
     """
-    basename = os.path.basename(filename)
-    return basename.replace("-compspec.json", "-jobspec.yaml")
+    if index in graph["edges"]:
+        return graph["edges"][index]
+    return {
+        "source": source,
+        "target": target,
+        "relation": graph["strings"][graph["relation"][index]],
+        "metadata": graph["edge_metadata"].get(index, {}),
+    }
+
+
+def iter_vertices(graph):
+    """
+    Yield the key and JGF of each vertex of a compact graph.
+
+    Paths of parents are kept as we go, so each path is derived once.
+    """
+    paths = {}
+    for index in range(len(graph["uniq_id"])):
+        path = graph["paths"].get(index)
+        parent = graph["parent"][index]
+        if path is None and index not in graph["vertices"] and parent != -1:
+            if parent not in paths:
+                paths[parent] = get_path(graph, parent)
+            if paths[parent] is not None:
+                name = graph["strings"][graph["basename"][index]]
+                path = f"{paths[parent]}/{name}{graph['id'][index]}"
+        yield get_key(graph, index), get_vertex(graph, index, path)
+
+
+def iter_edges(graph, keys):
+    """
+    Yield the JGF of each edge of a compact graph.
+    """
+    source, target = graph["source"], graph["target"]
+    for index in range(len(graph["relation"])):
+        if index in graph["edges"]:
+            yield graph["edges"][index]
+        else:
+            yield get_edge(graph, index, keys[source[index]], keys[target[index]])
+
+
+def get_vertex_type(graph, index):
+    """
+    Get the type of a vertex without building it.
+    """
+    if index in graph["vertices"]:
+        return graph["vertices"][index]["metadata"].get("type")
+    return graph["strings"][graph["type"][index]]
+
+
+def attach_subsystems(graph, subsystems, uid):
+    """
+    Yield a vertex for each subsystem of each node in the cluster graph.
+
+    Vertex ids continue from uid, and are derived in the same order each
+    time, so we can iterate once for vertices and again for edges without
+    keeping them in memory. The id (and name) of a vertex is counted
+    within its subsystem, like the ids of each type in the cluster graph.
+    """
+    count = 0
+    counts = {subsystem: 0 for subsystem in subsystems}
+    for index in range(len(graph["uniq_id"])):
+        if get_vertex_type(graph, index) != "node":
+            continue
+        node = get_vertex(graph, index)
+        node_id = get_key(graph, index)
+        path = node["metadata"]["paths"]["containment"]
+        for subsystem, attributes in subsystems.items():
+            vertex_id = uid + count
+            local_id = counts[subsystem]
+            vertex = {
+                "label": str(vertex_id),
+                "metadata": {
+                    "attributes": attributes,
+                    "basename": subsystem,
+                    "exclusive": False,
+                    "id": str(local_id),
+                    "name": f"{subsystem}{local_id}",
+                    "paths": {subsystem: f"{path}/{subsystem}{local_id}"},
+                    "rank": node["metadata"]["rank"],
+                    "size": 1,
+                    "type": subsystem,
+                    "uniq_id": vertex_id,
+                    "unit": "",
+                },
+            }
+            count += 1
+            counts[subsystem] += 1
+            yield node_id, str(vertex_id), subsystem, vertex
+
+
+def write_items(fd, items, mapping=False, batch=10000):
+    """
+    Stream json items (or key, value pairs if mapping) to an open file.
+
+    Items are encoded in batches, so the (C) encoder does most of the
+    work without holding more than a batch in memory.
+    """
+    sep = ""
+    chunk = []
+    for item in itertools.chain(items, [None]):
+        if item is not None:
+            chunk.append(item)
+        if chunk and (item is None or len(chunk) == batch):
+            content = json.dumps(dict(chunk) if mapping else chunk)
+            fd.write(sep + content[1:-1])
+            sep = ", "
+            chunk = []
+    return sep != ""
+
+
+def write_graph(graph, subsystems, filename):
+    """
+    Write the (compact) cluster graph with subsystem vertices and edges to file.
+
+    The graph is streamed to the file instead of built as one big dict,
+    which matters for graphs with many cores. Without subsystems, this
+    writes back the same graph that was loaded.
+    """
+    keys = [get_key(graph, i) for i in range(len(graph["uniq_id"]))]
+    uid = max((int(x) for x in keys), default=-1) + 1
+    vertices = (
+        (vertex_id, vertex)
+        for _, vertex_id, _, vertex in attach_subsystems(graph, subsystems, uid)
+    )
+    edges = (
+        {
+            "source": source,
+            "target": target,
+            "relation": relation,
+            "metadata": {"subsystem": subsystem},
+        }
+        for node_id, vertex_id, subsystem, _ in attach_subsystems(
+            graph, subsystems, uid
+        )
+        for source, target, relation in [
+            (node_id, vertex_id, "contains"),
+            (vertex_id, node_id, "in"),
+        ]
+    )
+    with open(filename, "w") as fd:
+        fd.write("{")
+        for i, (name, value) in enumerate(graph["content"].items()):
+            fd.write(f"{', ' if i else ''}{json.dumps(name)}: ")
+            if name != "graph":
+                fd.write(json.dumps(value))
+                continue
+
+            # The graph is written in order, streaming nodes and edges
+            fd.write("{")
+            for j, (key, value) in enumerate(value.items()):
+                fd.write(f"{', ' if j else ''}{json.dumps(key)}: ")
+                if key == "nodes":
+                    fd.write("{")
+                    nodes = itertools.chain(iter_vertices(graph), vertices)
+                    write_items(fd, nodes, mapping=True)
+                    fd.write("}")
+                elif key == "edges":
+                    fd.write("[")
+                    write_items(fd, itertools.chain(iter_edges(graph, keys), edges))
+                    fd.write("]")
+                else:
+                    fd.write(json.dumps(value))
+            fd.write("}")
+        fd.write("}\n")
 
 
 def main():
     parser = get_parser()
     args, _ = parser.parse_known_args()
 
-    # Also organize results by mode
-    if not os.path.exists(args.outdir):
-        os.makedirs(args.outdir)
-
     # Show parameters to the user
-    print(f"▶️  Output directory: {args.outdir}")
+    print(f"▶️     Cluster graph: {args.cluster}")
     print(f"▶️   Input directory: {args.indir}")
 
-    # These are the levels (and associated groups we include for each)
-    # A lookup of the attributes we care about for each level
-    levels = {
-        "platform": {"io.archspec": ["cpu.target"]},
-        "os": {"io.archspec": ["cpu.target"], "os": ["os.name", "os.vendor"]},
-        "os-version": {
-            "io.archspec": ["cpu.target"],
-            "os": ["os.name", "os.vendor", "os.release"],
-        },
-        "descriptive": {
-            "io.archspec": ["cpu.target"],
-            "hardware": ["hardware.gpu.available"],
-            "os": ["os.name", "os.release", "os.vendor"],
-        },
-        "mpi": {
-            "io.archspec": ["cpu.target"],
-            "hardware": ["hardware.gpu.available"],
-            "os": ["os.name", "os.release", "os.vendor"],
-            "mpi": ["mpi.implementation", "mpi.version"],
-        },
-    }
-    inputs = recursive_find(args.indir, ".+compspec[.]json")
-    for input_file in inputs:
-        # We need to generate a jobspec for each compatibility level.
-        compspec = read_json(input_file)
-        command = [
-            "lmp",
-            "-v",
-            "x",
-            "2",
-            "-v",
-            "y",
-            "2",
-            "-v",
-            "z",
-            "2",
-            "-in",
-            "./in.reaxff.hns",
-            "-nocite",
-        ]
-        if "gpu" in input_file:
-            command[0] = "lmp_gpu"
-
-        # Generate a jobspec for each level
-        for level, attributes in levels.items():
-            js = converter.from_compatibility_spec(
-                compspec,
-                command,
-                args.nodes,
-                tasks=args.tasks,
-                name=f"lammps-{level}",
-                attributes=attributes,
-            )
-            outdir = os.path.join(args.outdir, level)
-            if not os.path.exists(outdir):
-                os.makedirs(outdir)
-            outfile = compspec_file_to_jobspec_file(input_file)
-            outfile = os.path.join(outdir, outfile)
-            print(f"Writing {level} jobspec {os.path.basename(outfile)}")
-            write_yaml(js, outfile)
+    # Each node metadata file gets a subsystem graph, written alongside it
+    if args.node:
+        inputs = {args.node: args.out}
+    else:
+        inputs = {x: None for x in recursive_find(args.indir)}
+
+    graph = load_graph(args.cluster)
+    count = len(graph["uniq_id"])
+    print(f"Loaded {count} vertices ({len(graph['vertices'])} do not fit columns)")
+    for input_file, outfile in inputs.items():
+        subsystems = read_subsystems(input_file)
+        if not outfile:
+            outfile = os.path.join(os.path.dirname(input_file), "subsystems.json")
+        print(f"Writing subsystem graph {outfile}")
+        write_graph(graph, subsystems, outfile)
 
 
 if __name__ == "__main__":
@@ -13,11 +13,15 @@ import sys
 import tempfile
 import yaml
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-
 here = os.path.abspath(os.path.dirname(__file__))
 
+# An install prefix in the spack store is named <name>-<version>-<hash>, and
+# the hash can be shortened in the projection (e.g., {hash:7})
+prefix_regex = re.compile(r"^(?P<name>.+)-(?P<version>[^-]+)-(?P<hash>[a-z0-9]{7,32})$")
+
 
 def write_json(content, filename):
     """
@@ -128,72 +132,238 @@ template = {
 }
 
 
+def is_prefix(entry):
+    """
+    Determine if a directory entry is an install prefix.
+
+    A short hash could also be the end of another name (e.g., the
+    linux-rhel8-broadwell architecture directory), so we check those
+    for the .spack metadata directory.
+    """
+    match = prefix_regex.match(entry.name)
+    if not match:
+        return False
+    if len(match.group("hash")) == 32:
+        return True
+    return os.path.isdir(os.path.join(entry.path, ".spack"))
+
+
+def scan_prefixes(path, cached, index):
+    """
+    Find install prefixes under a directory of the spack store.
+
+    We stop at the <name>-<version>-<hash> level instead of walking into every
+    prefix. A directory listing in the cached index is reused when the directory
+    has not changed since (adding or removing an install updates its mtime),
+    and was listed with the same prefix pattern.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    listing = cached.get(path)
+    if (
+        not listing
+        or listing["mtime"] != mtime
+        or listing.get("pattern") != prefix_regex.pattern
+    ):
+        listing = {
+            "mtime": mtime,
+            "pattern": prefix_regex.pattern,
+            "dirs": [],
+            "prefixes": [],
+        }
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_dir(
+                    follow_symlinks=False
+                ):
+                    continue
+                if is_prefix(entry):
+                    listing["prefixes"].append(entry.name)
+                else:
+                    listing["dirs"].append(entry.name)
+    index[path] = listing
+
+    for name in listing["prefixes"]:
+        yield os.path.join(path, name)
+    for name in listing["dirs"]:
+        yield from scan_prefixes(os.path.join(path, name), cached, index)
+
+
+def find_packages(opt_dir, regex, index_file=None):
+    """
+    Find install prefixes with a spec.json that match the package regex.
+
+    If an index file is provided, it is used to skip listing directories
+    that have not changed, and then updated for the next run.
+    """
+    cached = {}
+    if index_file and os.path.exists(index_file):
+        cached = read_json(index_file)
+    index = {}
+    packages = []
+    for prefix in scan_prefixes(opt_dir, cached, index):
+        if not re.search(regex, prefix):
+            continue
+        if os.path.exists(os.path.join(prefix, ".spack", "spec.json")):
+            packages.append(prefix)
+    if index_file:
+        write_json(index, index_file)
+    if not any(listing["prefixes"] for listing in index.values()):
+        print(
+            f"No install prefixes (<name>-<version>-<hash>) found in {opt_dir}, check the store projection."
+        )
+    return sorted(packages)
+
+
+def load_package(package):
+    """
+    Read the (indexed) spec and install environment for an install prefix.
+    """
+    index = index_spec(read_json(os.path.join(package, ".spack", "spec.json")))
+    environ = read_json(os.path.join(package, ".spack", "install_environment.json"))
+    return index, environ
+
+
+def index_spec(spack_spec):
+    """
+    Index the nodes of a spec.json by hash and name, and the providers of virtuals.
+
+    The index is built once per package (when it is read) and used for every
+    lookup after that, instead of scanning the nodes each time.
+
+    Providers are taken from the virtuals recorded on dependency edges. The root
+    (first node) is indexed first, so its own providers win over those deeper
+    in the DAG.
+    """
+    nodes = spack_spec["spec"]["nodes"]
+    by_hash = {node["hash"]: node for node in nodes}
+    by_name = {}
+    providers = {}
+    for node in nodes:
+        by_name.setdefault(node["name"], node)
+        for dep in node.get("dependencies", []):
+            provider = by_hash.get(dep["hash"])
+            if not provider:
+                continue
+            for virtual in dep.get("parameters", {}).get("virtuals", []):
+                providers.setdefault(virtual, provider)
+
+    return {
+        "spec": spack_spec,
+        "root": nodes[0],
+        "by_hash": by_hash,
+        "by_name": by_name,
+        "providers": providers,
+    }
+
+
+def get_provider(index, name):
+    """
+    Get the node that provides a virtual (e.g., mpi, blas) or package (e.g., cuda).
+
+    Older specs don't record virtuals, so we fall back to a dependency of the root
+    with the virtual in its name (e.g., openmpi) and then a node of that name.
+    """
+    if name in index["providers"]:
+        return index["providers"][name]
+    for dep in index["root"].get("dependencies", []):
+        if name in dep["name"] and dep["hash"] in index["by_hash"]:
+            return index["by_hash"][dep["hash"]]
+    return index["by_name"].get(name)
+
+
+def generate_compspec(compspec, index, environ):
+    """
+    Generate the compatibility spec for a package on a host.
+
+    NOTE: this is an imperfect process, the extractor metadata is a WIP and hugely
+    subject to change based on descisions of compatibility working group -
+    assume that everything will change.
+    """
+    spec = copy.deepcopy(template)
+
+    # This isn't exactly right, but it matches what we did for kubernetes experiments
+    spec["compatibilities"][0]["attributes"]["os.name"] = environ["host_os"]
+
+    arch_name = compspec["results"]["system"]["sections"]["arch"]["name"]
+    spec["compatibilities"][1]["attributes"]["cpu.target"] = arch_name
+    spec["compatibilities"][1]["attributes"]["cpu.model"] = environ["host_target"]
+
+    system = compspec["results"]["system"]["sections"]["processor"]
+    spec["compatibilities"][1]["attributes"]["cpu.vendor"] = system["0.vendor"]
+    spec["compatibilities"][1]["attributes"]["cpu.target"] = arch_name
+
+    nfd = compspec["results"]["nfd"]["sections"]["system"]
+    spec["compatibilities"][0]["attributes"]["os.release"] = nfd["osrelease.VERSION_ID"]
+    spec["compatibilities"][0]["attributes"]["os.vendor"] = nfd["osrelease.ID"]
+
+    # Get the specific MPI provider
+    mpi = get_provider(index, "mpi")
+    if mpi:
+        spec["compatibilities"][0]["attributes"]["mpi.implementation"] = mpi["name"]
+        spec["compatibilities"][0]["attributes"]["mpi.version"] = mpi.get("version")
+
+    # hardware.gpu.available
+    has_gpu = "no"
+    if get_provider(index, "cuda"):
+        has_gpu = "yes"
+    spec["compatibilities"][0]["attributes"]["hardware.gpu.available"] = has_gpu
+    return spec
+
+
+def load_hosts(args):
+    """
+    Load host compspec metadata and the output directory for each host.
+
+    With a directory of hosts (compspec-<host>.json), artifacts for each
+    host are written to a subdirectory of the output directory named for it.
+    """
+    if not args.hosts_dir:
+        return [(args.outdir, read_json(args.compspec))]
+
+    hosts = []
+    for filename in sorted(recursive_find(args.hosts_dir, "*.json")):
+        hostname = (
+            os.path.basename(filename).replace(".json", "").replace("compspec-", "")
+        )
+        host_outdir = os.path.join(args.outdir, hostname)
+        if not os.path.exists(host_outdir):
+            os.makedirs(host_outdir)
+        hosts.append((host_outdir, read_json(filename)))
+    print(f"Found {len(hosts)} hosts in {args.hosts_dir}")
+    return hosts
+
+
 def run(args, outdir):
     """
     Run the experiments for a given experiment type.
     """
     opt_dir = os.path.join(args.spack_root, "opt")
-    packages = []
     regex = "(%s)" % "|".join(args.package)
-    for spec_file in recursive_find(opt_dir, "spec.json"):
-        if not re.search(regex, spec_file):
-            continue
-        packages.append(os.path.dirname(os.path.dirname(spec_file)))
+    packages = find_packages(opt_dir, regex, args.index)
     print(f"Found {len(packages)} package for {args.package}")
 
     # Load host compspec metadata
-    compspec = read_json(args.compspec)
-
-    # For each, read in the spec.json and get host metadata
-    # NOTE: this is an imperfect process, the extractor metadata is a WIP and hugely
-    # subject to change based on descisions of compatibility working group -
-    # assume that everything will change.
-    for package in packages:
-        spec = copy.deepcopy(template)
-        spec_json = os.path.join(package, ".spack", "spec.json")
-        env_file = os.path.join(package, ".spack", "install_environment.json")
-        spack_spec = read_json(spec_json)
-        environ = read_json(env_file)
-
-        # This isn't exactly right, but it matches what we did for kubernetes experiments
-        spec["compatibilities"][0]["attributes"]["os.name"] = environ["host_os"]
-
-        arch_name = compspec["results"]["system"]["sections"]["arch"]["name"]
-        spec["compatibilities"][1]["attributes"]["cpu.target"] = arch_name
-        spec["compatibilities"][1]["attributes"]["cpu.model"] = environ["host_target"]
-
-        system = compspec["results"]["system"]["sections"]["processor"]
-        spec["compatibilities"][1]["attributes"]["cpu.vendor"] = system["0.vendor"]
-        spec["compatibilities"][1]["attributes"]["cpu.target"] = arch_name
-
-        nfd = compspec["results"]["nfd"]["sections"]["system"]
-        spec["compatibilities"][0]["attributes"]["os.release"] = nfd[
-            "osrelease.VERSION_ID"
-        ]
-        spec["compatibilities"][0]["attributes"]["os.vendor"] = nfd["osrelease.ID"]
-
-        # Get the specific MPI - if this is a virtual, won't be here
-        mpi = [
-            x
-            for x in spack_spec["spec"]["nodes"][0]["dependencies"]
-            if "mpi" in x["name"]
-            or "mpi" in x.get("parameters", {}).get("virtuals", [])
-        ]
-        print(mpi)
-        mpi = [x for x in spack_spec["spec"]["nodes"] if x["hash"] == mpi[0]["hash"]]
-        spec["compatibilities"][0]["attributes"]["mpi.implementation"] = mpi[0]["name"]
-        spec["compatibilities"][0]["attributes"]["mpi.version"] = mpi[0].get("version")
-
-        # hardware.gpu.available
-        has_gpu = "no"
-        test = [x["name"] for x in spack_spec["spec"]["nodes"] if "cuda" in x["name"]]
-        if test:
-            has_gpu = "yes"
-        spec["compatibilities"][0]["attributes"]["hardware.gpu.available"] = has_gpu
-
-        # Write to output file
-        package_hash = "%s.json" % os.path.join(args.outdir, os.path.basename(package))
-        write_json(spec, package_hash)
+    hosts = load_hosts(args)
+
+    # For each, read in the spec.json and get host metadata. Reading is
+    # I/O bound (and slow on shared filesystems), so we do it in threads.
+    # Each package is read once and used for every host.
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        loaded = executor.map(load_package, packages)
+        writes = []
+        for package, (index, environ) in zip(packages, loaded):
+            for host_outdir, compspec in hosts:
+                spec = generate_compspec(compspec, index, environ)
+
+                # Write to output file
+                package_hash = "%s.json" % os.path.join(
+                    host_outdir, os.path.basename(package)
+                )
+                writes.append(executor.submit(write_json, spec, package_hash))
+
+        # Raise any error writing
+        for write in writes:
+            write.result()
 
 
 def confirm_action(question):
@@ -226,11 +396,25 @@ def get_parser():
         dest="compspec",
         help="host compatibility information",
     )
+    parser.add_argument(
+        "--hosts-dir",
+        dest="hosts_dir",
+        help="directory of host compatibility information (compspec-<host>.json) to generate artifacts for each",
+    )
     parser.add_argument(
         "--outdir",
         default=os.path.join(here, "results"),
         help="output directory for results",
     )
+    parser.add_argument(
+        "--workers",
+        help="number of threads to read package specs (defaults to python's choice)",
+        type=int,
+    )
+    parser.add_argument(
+        "--index",
+        help="index of the spack store to save, so repeated runs only list new installs",
+    )
     return parser
 
 
@@ -242,11 +426,12 @@ def main():
     if not os.path.exists(args.spack_root):
         sys.exit(f"{args.spack_root} does not exist.")
 
-    if not args.compspec:
-        sys.exit(f"--compspec-json is required.")
+    if not args.compspec and not args.hosts_dir:
+        sys.exit(f"--compspec-json or --hosts-dir is required.")
 
-    if not os.path.exists(args.compspec):
-        sys.exit(f"{args.compspec} does not exist.")
+    for path in [args.compspec, args.hosts_dir]:
+        if path and not os.path.exists(path):
+            sys.exit(f"{path} does not exist.")
 
     if not args.package:
         sys.exit("Please provide the name of one or more packages with --package")
@@ -29,6 +29,10 @@ def get_parser():
         help="directory to save parsed results",
         default=os.path.join(here, "img"),
     )
+    parser.add_argument(
+        "--store",
+        help="columnar (parquet) results store to read instead of the results file",
+    )
     return parser
 
 
@@ -90,11 +94,39 @@ def main():
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-    df, levels = parse_data(infile)
+    if args.store:
+        df, levels = read_store(args.store)
+    else:
+        df, levels = parse_data(infile)
     print(levels)
     df.to_csv(os.path.join(outdir, "simulation-results.csv"))
 
 
+def read_store(store):
+    """
+    Read the columns we need from the results store written by simulate_runs.py
+    """
+    df = pandas.read_parquet(
+        store, columns=["needed", "choice", "correct", "binary", "experiment"]
+    )
+    df["experiment"] = df["experiment"].astype(str)
+    return df, get_levels(df)
+
+
+def get_levels(df):
+    """
+    Get the fraction correct for each experiment
+    """
+    # Keep track of counts of correct / incorrect
+    levels = {}
+    for experiment in df.experiment.unique():
+        subset = df[df.experiment == experiment]
+        total = subset.shape[0]
+        correct = subset[subset.correct == True].shape[0]
+        levels[experiment] = correct / total
+    return levels
+
+
 def parse_data(infile):
     """
     Given a listing of files, parse into results data frame
@@ -127,15 +159,7 @@ def parse_data(infile):
                 ]
                 idx += 1
 
-    # Keep track of counts of correct / incorrect
-    levels = {}
-    for experiment in df.experiment.unique():
-        subset = df[df.experiment == experiment]
-        total = subset.shape[0]
-        correct = subset[subset.correct == True].shape[0]
-        levels[experiment] = correct / total
-
-    return df, levels
+    return df, get_levels(df)
 
 
 if __name__ == "__main__":
@@ -2,19 +2,44 @@
 
 import argparse
 import json
+import math
 import os
 import random
 import fnmatch
 
 here = os.path.dirname(os.path.abspath(__file__))
 
-# Descriptive modes of metadata
-modes = [
-    "basic",
-    "platform-version",
-    "descriptive-basic",
+# Descriptive modes of metadata, and the spec attributes we select hosts on for each.
+# os name isn't meaningful because they all are rhel, so we just consider version.
+# Including MPI variant is as far as we go, because we don't have many choices.
+modes = {
+    "basic": ["cpu.target"],
+    "platform-version": ["cpu.target", "os.release"],
+    "descriptive-basic": ["cpu.target", "os.release", "mpi.implementation"],
+}
+
+# The host lookup (in select) for each spec attribute
+lookups = {
+    "cpu.target": ["platform"],
+    "os.name": ["os"],
+    "os.release": ["os"],
+    "mpi.implementation": ["mpi", "variant"],
+    "mpi.version": ["mpi", "version"],
+    "hardware.gpu.available": ["gpu"],
+}
+
+# Columns of the results store (experiment is the partition)
+store_schema = [
+    ("iter", "int64"),
+    ("binary", "string"),
+    ("needed", "string"),
+    ("choice", "string"),
+    ("correct", "bool"),
 ]
 
+# z score for the confidence intervals of expected accuracy (95%)
+z_score = 1.96
+
 # The truth of where the binary should actually run (where it was built)
 truth = {
     "lammps-20230802.2-l75zzkprajipt5e5daomwfyxe3meus3q.json": "corona",
@@ -63,6 +88,211 @@ def read_json(filename):
     return json.loads(read_file(filename))
 
 
+def get_index(select, bits=None):
+    """
+    Turn the select lookup into a bitset index.
+
+    Each host is given a bit, and each attribute value becomes an integer
+    mask of the hosts that have it. Matching several attributes is then a
+    few AND operations instead of set intersections of host lists.
+    """
+    bits = {} if bits is None else bits
+    index = {}
+    for key, value in select.items():
+        if isinstance(value, dict):
+            index[key] = get_index(value, bits)[0]
+            continue
+        mask = 0
+        for hostname in value:
+            mask |= bits.setdefault(hostname, 1 << len(bits))
+        index[key] = mask
+    return index, list(bits)
+
+
+def get_hosts(mask, hostnames):
+    """
+    Get the (sorted) hostnames for the bits set in a mask.
+    """
+    hosts = []
+    while mask:
+        bit = mask & -mask
+        hosts.append(hostnames[bit.bit_length() - 1])
+        mask ^= bit
+    return sorted(hosts)
+
+
+def get_needed(spec):
+    """
+    Get the attributes a spec needs, across compatibilities.
+    """
+    needed = {}
+    for compatibility in spec["compatibilities"]:
+        needed.update(compatibility["attributes"])
+    return needed
+
+
+def get_choices(modes, index, hostnames, needed):
+    """
+    Get the hosts we can choose from for each mode.
+
+    The candidates only depend on the mode and binary, so we derive them
+    once instead of for every iteration. Intersections are shared between
+    modes that start with the same attributes.
+    """
+    masks = {(): (1 << len(hostnames)) - 1}
+    choices = {}
+    for mode, attributes in modes.items():
+        for i, attribute in enumerate(attributes):
+            key = tuple(attributes[: i + 1])
+            if key in masks:
+                continue
+            lookup = index
+            for name in lookups[attribute]:
+                lookup = lookup[name]
+            masks[key] = masks[key[:-1]] & lookup.get(needed.get(attribute), 0)
+        choices[mode] = get_hosts(masks[tuple(attributes)], hostnames)
+    return choices
+
+
+def simulate_python(choices, needed, iters):
+    """
+    Randomly select from choices, one iteration at a time.
+    """
+    results = []
+    for _ in range(iters):
+        choice = random.choice(choices) if choices else None
+        results.append(
+            {
+                "selected": choice,
+                "needed": needed,
+                "correct": choice == needed,
+            }
+        )
+    return results
+
+
+def simulate_numpy(choices, needed, iters, rng):
+    """
+    Randomly select from choices for all iterations at once.
+
+    Each iteration is a uniform draw from the same candidates, so we draw
+    all indices in one call and compare to the truth as an array. The
+    results are kept as columns (arrays) instead of a record per draw.
+    """
+    import numpy
+
+    if not choices:
+        return {
+            "iter": numpy.arange(iters),
+            "choice": numpy.full(iters, None, dtype=object),
+            "correct": numpy.zeros(iters, dtype=bool),
+        }
+
+    selected = numpy.array(choices)[rng.integers(0, len(choices), size=iters)]
+    return {
+        "iter": numpy.arange(iters),
+        "choice": selected,
+        "correct": selected == needed,
+    }
+
+
+def get_columns(results):
+    """
+    Get the columns of results from the python engine (a record per draw).
+    """
+    return {
+        "iter": list(range(len(results))),
+        "choice": [x["selected"] for x in results],
+        "correct": [x["correct"] for x in results],
+    }
+
+
+def count_correct(results):
+    """
+    Count the correct draws and all draws for each mode, for either engine.
+    """
+    counts = {}
+    for mode, binaries in results.items():
+        correct = total = 0
+        for result in binaries.values():
+            if isinstance(result, list):
+                result = get_columns(result)
+            correct += int(sum(result["correct"]))
+            total += len(result["correct"])
+        counts[mode] = (correct, total)
+    return counts
+
+
+def get_expected(choices, needed, iters):
+    """
+    Get the exact expected accuracy of randomly selecting from choices.
+
+    A uniform draw is correct with probability 1/len(choices) when the truth
+    is a candidate (and never otherwise), so we don't need to sample it. The
+    confidence interval is for the accuracy measured over iters draws.
+    """
+    accuracy = 0.0
+    if needed in choices:
+        accuracy = 1 / len(choices)
+    variance = accuracy * (1 - accuracy)
+    return {
+        "choices": len(choices),
+        "accuracy": accuracy,
+        "variance": variance,
+        "ci": get_interval(accuracy, variance, iters),
+    }
+
+
+def get_interval(accuracy, variance, count):
+    """
+    Get the normal confidence interval for an accuracy measured count times.
+    """
+    if not count:
+        return [accuracy, accuracy]
+    margin = z_score * math.sqrt(variance / count)
+    return [max(0.0, accuracy - margin), min(1.0, accuracy + margin)]
+
+
+def summarize_expected(expected, iters):
+    """
+    Summarize the expected accuracy of each mode across binaries.
+
+    The mode accuracy is the mean over binaries, so its variance (for one
+    draw of each) is the sum of the binary variances over the count squared.
+    A mode without binaries has no expected accuracy.
+    """
+    for mode, binaries in expected.items():
+        count = len(binaries)
+        accuracy = variance = ci = None
+        if count:
+            accuracy = sum(x["accuracy"] for x in binaries.values()) / count
+            variance = sum(x["variance"] for x in binaries.values()) / count**2
+            ci = get_interval(accuracy, variance, iters)
+        expected[mode] = {
+            "accuracy": accuracy,
+            "variance": variance,
+            "ci": ci,
+            "binaries": binaries,
+        }
+    return expected
+
+
+def check_expected(expected, counts):
+    """
+    Cross-check the Monte Carlo accuracy against the expected accuracy.
+    """
+    for mode, summary in expected.items():
+        correct, total = counts[mode]
+        if not total or summary["accuracy"] is None:
+            continue
+        observed = correct / total
+        low, high = summary["ci"]
+        status = "✅️" if low <= observed <= high else "❌️"
+        print(
+            f"{status} {mode}: observed {observed:.4f}, expected {summary['accuracy']:.4f} ({low:.4f}-{high:.4f})"
+        )
+
+
 def run(args, outdir):
     """
     Run the experiments across modes.
@@ -137,83 +367,98 @@ def run(args, outdir):
             select["mpi"]["version"][mpi_version] = []
         select["mpi"]["version"][mpi_version].append(hostname)
 
+    # Each host gets a bit, and each attribute value a mask of hosts
+    index, hostnames = get_index(select)
+
+    # Seed the random generators so a simulation can be repeated
+    rng = None
+    if args.engine == "numpy":
+        import numpy
+
+        rng = numpy.random.default_rng(args.seed)
+    elif args.seed is not None:
+        random.seed(args.seed)
+
+    # Modes can also be declared in a json file (mode name to attributes)
+    experiment_modes = read_json(args.modes) if args.modes else modes
+    for mode, attributes in experiment_modes.items():
+        unknown = [x for x in attributes if x not in lookups]
+        if unknown:
+            raise ValueError(f"Mode {mode} has unknown attributes {unknown}")
+
+    # What we have to choose from is the same for every iteration, so
+    # derive it for all modes in one pass over the binaries
+    choices = {}
+    for specname, spec in specs.items():
+        choices[specname] = get_choices(
+            experiment_modes, index, hostnames, get_needed(spec)
+        )
+
     # Keep a matrix of results, basically store 1 if we got it right, 0 for wrong
-    results = {mode: {} for mode in modes}
+    results = {mode: {} for mode in experiment_modes}
+    expected = {mode: {} for mode in experiment_modes}
 
-    for mode in modes:
-        for specname, spec in specs.items():
+    for mode in experiment_modes:
+        for specname in specs:
             # Name of the binary to store results
             binary = specname.replace(".json", "")
 
             # The truth about where it needs to run
             needed = truth[specname]
 
-            if binary not in results[mode]:
-                results[mode][binary] = []
-
-            # Pull out what the spec needs, we might not use all of it for each mode
-            needed_platform = spec["compatibilities"][1]["attributes"]["cpu.target"]
-            needed_variant = spec["compatibilities"][0]["attributes"][
-                "mpi.implementation"
-            ]
-
-            # This might not be meaningful unless there are OS ABI issues
-            needed_os_version = spec["compatibilities"][0]["attributes"]["os.release"]
-
-            # What we have to choose from
-            systems_for_platform = select["platform"][needed_platform]
-            os_versions = select["os"][needed_os_version]
-            mpi_variants = select["mpi"]["variant"][needed_variant]
-
-            for iter in range(args.iters):
-                # Basic mode, just select based on platform
-                if mode == "basic":
-                    choice = random.choice(select["platform"][needed_platform])
-                    results[mode][binary].append(
-                        {
-                            "selected": choice,
-                            "needed": needed,
-                            "correct": choice == needed,
-                        }
-                    )
-
-                # This adds in os name, which isn't meaningful because they all are rhel. We are going to
-                # skip this case and just consider version
-                elif mode == "platform-version":
-                    choice = None
-                    choices = list(
-                        set(systems_for_platform).intersection(set(os_versions))
-                    )
-                    if choices:
-                        choice = random.choice(choices)
-                    results[mode][binary].append(
-                        {
-                            "selected": choice,
-                            "needed": needed,
-                            "correct": choice == needed,
-                        }
-                    )
-
-                # This is all including MPI, but I don't think we need that because we don't have many choices
-                elif mode == "descriptive-basic":
-                    choice = None
-                    choices = list(
-                        set(systems_for_platform)
-                        .intersection(set(os_versions))
-                        .intersection(mpi_variants)
-                    )
-                    if choices:
-                        choice = random.choice(choices)
-                    results[mode][binary].append(
-                        {
-                            "selected": choice,
-                            "needed": needed,
-                            "correct": choice == needed,
-                        }
-                    )
+            options = choices[specname][mode]
+            if args.expected:
+                expected[mode][binary] = get_expected(options, needed, args.iters)
+            if args.engine == "numpy":
+                results[mode][binary] = simulate_numpy(options, needed, args.iters, rng)
+            else:
+                results[mode][binary] = simulate_python(options, needed, args.iters)
 
     print(f"🧪️ Experiments are finished. See output in {outdir}")
-    write_json(results, os.path.join(outdir, "simulation-results.json"))
+
+    # The numpy engine keeps columns (not a record per draw), only for the store
+    if args.engine == "python":
+        write_json(results, os.path.join(outdir, "simulation-results.json"))
+    if args.store:
+        write_store(results, truth, args.store)
+    if args.expected:
+        expected = summarize_expected(expected, args.iters)
+        write_json(expected, os.path.join(outdir, "simulation-expected.json"))
+        check_expected(expected, count_correct(results))
+
+
+def write_store(results, truth, store):
+    """
+    Write simulation results to the columnar (parquet) results store.
+
+    The store is partitioned by experiment (mode), and each simulation
+    replaces the results for the modes it ran. plot-results.py can then
+    read only the columns it needs.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([pa.field(name, kind) for name, kind in store_schema])
+    for mode, binaries in results.items():
+        tables = []
+        for binary, result in binaries.items():
+            if isinstance(result, list):
+                result = get_columns(result)
+            count = len(result["correct"])
+            columns = {
+                "iter": pa.array(result["iter"], type=pa.int64()),
+                "binary": pa.repeat(binary, count),
+                "needed": pa.repeat(truth[f"{binary}.json"], count),
+                "choice": pa.array(result["choice"], type=pa.string()),
+                "correct": pa.array(result["correct"], type=pa.bool_()),
+            }
+            tables.append(pa.table(columns, schema=schema))
+        path = os.path.join(store, f"experiment={mode}")
+        os.makedirs(path, exist_ok=True)
+        filename = os.path.join(path, "simulation.parquet")
+        table = pa.concat_tables(tables) if tables else schema.empty_table()
+        pq.write_table(table, f"{filename}.tmp")
+        os.replace(f"{filename}.tmp", filename)
 
 
 def confirm_action(question):
@@ -253,6 +498,31 @@ def get_parser():
         help="number of iterations to run for simulation",
         type=int,
     )
+    parser.add_argument(
+        "--store",
+        help="columnar (parquet) results store to write results to",
+    )
+    parser.add_argument(
+        "--engine",
+        default="python",
+        choices=["python", "numpy"],
+        help="simulation engine (numpy draws all iterations at once and only writes to --store, defaults to python)",
+    )
+    parser.add_argument(
+        "--seed",
+        help="seed for the random generator, to repeat a simulation",
+        type=int,
+    )
+    parser.add_argument(
+        "--modes",
+        help="json file of modes to simulate, each a list of spec attributes (defaults to basic, platform-version, descriptive-basic)",
+    )
+    parser.add_argument(
+        "--expected",
+        action="store_true",
+        default=False,
+        help="write the exact expected accuracy per mode (use --iters 0 to skip the simulation)",
+    )
     return parser
 
 
@@ -261,6 +531,10 @@ def main():
     args, _ = parser.parse_known_args()
     outdir = os.path.abspath(args.outdir)
 
+    # The numpy engine only writes results to the store
+    if args.engine == "numpy" and not args.store:
+        args.store = os.path.join(outdir, "store")
+
     # We will write data files here
     if not os.path.exists(outdir):
         os.makedirs(outdir)